@@ -1,4 +1,7 @@
 """The entry point of the process."""
 
 from robot_framework import linear_framework
-linear_framework.main()
+
+# The guard keeps worker processes from starting the robot again when they import this module.
+if __name__ == "__main__":
+    linear_framework.main()
@@ -20,9 +20,65 @@ KEYVAULT_CREDENTIALS = "Keyvault"
 KEYVAULT_URI = "Keyvault URI"
 KEYVAULT_PATH = "Statstidende"
 
+# The maximum number of days fetched from the Statstidende API at the same time
+STATSTIDENDE_MAX_WORKERS = 4
+
+# The minimum number of seconds between requests to the Statstidende API shared by all workers.
+# The API only allows one request per 10 seconds.
+STATSTIDENDE_MIN_REQUEST_INTERVAL = 10
+
+# The number of times a request is sent before giving up while the API is throttling
+STATSTIDENDE_MAX_TRIES = 10
+
+# The Statstidende API endpoint. Can be pointed to a local server to replay cached data offline.
+STATSTIDENDE_API_URL = "https://api.statstidende.dk/v1/messages"
+
+# Where raw Statstidende responses are cached and for how many days
+STATSTIDENDE_CACHE_DIR = "statstidende_cache"
+STATSTIDENDE_CACHE_RETENTION_DAYS = 14
+
+# The database of parsed Statstidende cases. Days are kept for the same retention period as the cache
+STATSTIDENDE_CASE_DATABASE = "statstidende_cases.sqlite3"
+
+# Match gældssaneringer when the first name is a substring of the name on the case
+# instead of a whole word of it. This is more lenient but gives false positives ("Ann" matches "Hanne").
+GAELDSSANERING_SUBSTRING_MATCH = False
+
+# The number of OPUS attachments to download at once and the number of processes parsing them
+OPUS_DOWNLOAD_WORKERS = 4
+OPUS_PARSE_WORKERS = 2
+
+# Where parsed OPUS attachments are cached between attempts. Each attachment is a file in a folder per email
+OPUS_ATTACHMENT_CACHE_DIR = "opus_attachments"
+
+# Match OPUS debitors in chunks of this size with numpy if it is installed (pip install .[batch]).
+# Set to 0 to match them one at a time
+BATCH_MATCHING_CHUNK_SIZE = 100_000
+
+# Run the OPUS branch in a worker thread while the KMD Boliglån branch runs in the main thread
+RUN_BRANCHES_CONCURRENTLY = True
+
+# The ledger of matches already reported. Only new matches are reported unless
+# INCLUDE_PREVIOUSLY_REPORTED is set, which adds them to a separate sheet
+SENT_MATCHES_DATABASE = "sent_matches.sqlite3"
+SENT_MATCHES_RETENTION_DAYS = 30
+INCLUDE_PREVIOUSLY_REPORTED = False
+PREVIOUSLY_REPORTED_SHEET = "Tidligere rapporteret"
+
+# The seconds to wait for a KMD Boliglån window to open, for a search to finish and to finish saving the export
+KMD_WINDOW_TIMEOUT = 30
+KMD_SEARCH_TIMEOUT = 300
+KMD_FILE_TIMEOUT = 30
+
+# Where KMD Boliglån lender exports are kept. An export from the same day is reused on retries.
+# With the reuse_lenders argument any export younger than the max age is reused instead.
+LENDER_SNAPSHOT_DIR = "boliglaan_snapshots"
+LENDER_SNAPSHOT_MAX_AGE_HOURS = 72
+
 # Argument json names
 OPUS_RECEIVERS = "opus_receivers"
 BOLIGLAAN_RECEIVERS = "boliglaan_receivers"
+REUSE_LENDERS = "reuse_lenders"
 
 # Where the resulting email comes from
 EMAIL_SENDER = "itk-rpa@mkb.aarhus.dk"
@@ -35,6 +91,7 @@ Her er listen med udsøgning fra Statstidende på debitorer i %SYSTEM% for de si
 Bemærk for at undgå fejl i forbindelse med udsøgningen er følgende valg taget:
 •\tGældssaneringer er fremsøgt via fødselsdato og fornavn.
 •\tTvangsauktioner er fremsøgt via vejnavn og postnummer
+•\tSager der er sendt på en tidligere liste er ikke med blandt de nye sager.
 I skal derfor selv være opmærksomme på om sagen er relevant. Tjek kolonne D op mod kolonne A-C
 
 Med venlig hilsen
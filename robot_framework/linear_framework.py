@@ -25,8 +25,9 @@ def main():
     error_count = 0
     for _ in range(config.MAX_RETRY_COUNT):
         try:
-            reset.reset(orchestrator_connection)
-            process.process(orchestrator_connection)
+            attempt = process.start_attempt(orchestrator_connection)
+            reset.reset(orchestrator_connection, attempt)
+            process.process(orchestrator_connection, attempt)
             break
 
         # If any business rules are broken the robot should stop entirely.
@@ -1,66 +1,195 @@
 """This module contains the main process of the robot."""
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
 import os
 import json
+from typing import Callable, NamedTuple
 
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
 import itk_dev_event_log
 
 from robot_framework import config
-from robot_framework.sub_process import common, opus, kmd_boliglaan
+from robot_framework.sub_process import common, opus, kmd_boliglaan, sent_matches
 from robot_framework.sub_process.statstidende import statstidende
 
+# The stages of the process that write a checkpoint file
+STATSTIDENDE_STAGE = "statstidende"
+OPUS_STAGE = "opus"
+BOLIGLAAN_STAGE = "boliglaan"
+# The KMD Boliglån export within the Boliglån stage. Only this stage needs KMD Boliglån to be open
+BOLIGLAAN_EXPORT_STAGE = "boliglaan_export"
 
-def process(orchestrator_connection: OrchestratorConnection) -> None:
+
+class Attempt(NamedTuple):
+    """The arguments, start time and pending stages of an attempt.
+    An attempt is started for each try in linear_framework and passed to both reset and process,
+    so they agree on the date and the pending stages even if the attempt crosses midnight.
+    """
+    opus_receivers: list[str]
+    boliglaan_receivers: list[str]
+    reuse_lenders: bool
+    now: datetime
+    pending_stages: frozenset[str]
+
+    @property
+    def today(self) -> date:
+        """The date of the attempt."""
+        return self.now.date()
+
+
+def start_attempt(orchestrator_connection: OrchestratorConnection) -> Attempt:
+    """Parse the process arguments, fix the time and find the pending stages of a new attempt.
+
+    Args:
+        orchestrator_connection: The connection to OpenOrchestrator.
+
+    Returns:
+        The new attempt.
+    """
+    arguments = json.loads(orchestrator_connection.process_arguments)
+    reuse_lenders = arguments.get(config.REUSE_LENDERS, False)
+    now = datetime.now()
+    return Attempt(
+        opus_receivers=arguments[config.OPUS_RECEIVERS],
+        boliglaan_receivers=arguments[config.BOLIGLAAN_RECEIVERS],
+        reuse_lenders=reuse_lenders,
+        now=now,
+        pending_stages=get_pending_stages(now, reuse_lenders)
+    )
+
+
+def process(orchestrator_connection: OrchestratorConnection, attempt: Attempt) -> None:
     """Do the primary process of the robot."""
     orchestrator_connection.log_trace("Running process.")
-    arguments = json.loads(orchestrator_connection.process_arguments)
-    opus_receivers = arguments[config.OPUS_RECEIVERS]
-    boliglaan_receivers = arguments[config.BOLIGLAAN_RECEIVERS]
+    today = attempt.today
 
     event_log = orchestrator_connection.get_constant("Event Log")
     itk_dev_event_log.setup_logging(event_log.value)
 
-    # Load cases from Statstidende
-    date = datetime.now().strftime('%d-%m-%Y')
-
-    statstidende_path = f'cases {date}.json'
+    checkpoint_paths = get_checkpoint_paths(today)
+    statstidende_path = checkpoint_paths[STATSTIDENDE_STAGE]
+    opus_path = checkpoint_paths[OPUS_STAGE]
+    boliglaan_path = checkpoint_paths[BOLIGLAAN_STAGE]
+    opus_name = os.path.splitext(opus_path)[0]
+    boliglaan_name = os.path.splitext(boliglaan_path)[0]
+    pending_stages = attempt.pending_stages
 
-    if not os.path.isfile(statstidende_path):
+    # Load cases from Statstidende
+    if STATSTIDENDE_STAGE in pending_stages:
         statstidende.create_cases_file(statstidende_path, orchestrator_connection)
 
-    with open(statstidende_path, 'r', encoding='utf-8') as file:
-        cases = json.load(file)
+    cases = statstidende.load_cases_file(statstidende_path)
+    matcher = common.Matcher(cases, substring_match=config.GAELDSSANERING_SUBSTRING_MATCH)
 
-    # Load data from OPUS emails and find relevant cases
-    opus_name = f"Opus Statstidende {date}"
-    opus_path = opus_name + ".xlsx"
+    # Log in to Graph once for reading and deleting the OPUS emails
+    mail_client = opus.MailClient(opus.authorize_graph(orchestrator_connection))
 
-    if not os.path.isfile(opus_path):
-        opus_cases = opus.find_relevant_cases(cases, orchestrator_connection)
-        opus.write_excel(opus_path, opus_cases)
+    # Load data from OPUS emails and Boliglån and find relevant cases.
+    # The number of cases is logged when a workbook is written, since a retry skips the finished stages.
+    def run_opus():
+        count = opus.write_excel(opus_path, opus.find_relevant_cases(matcher, orchestrator_connection, mail_client), today)
+        itk_dev_event_log.emit(orchestrator_connection.process_name, "Opus cases found", count)
 
-    # Load data from Boliglån and find relevant cases
-    boliglaan_name = f"Boliglån Statstidende {date}"
-    boliglaan_path = boliglaan_name + ".xlsx"
+    def run_boliglaan():
+        count = kmd_boliglaan.write_excel(boliglaan_path, kmd_boliglaan.find_relevant_cases(matcher, orchestrator_connection, attempt.reuse_lenders, attempt.now), today)
+        itk_dev_event_log.emit(orchestrator_connection.process_name, "Boliglån cases found", count)
 
-    if not os.path.isfile(boliglaan_path):
-        boliglaan_cases = kmd_boliglaan.find_relevant_cases(cases, orchestrator_connection)
-        kmd_boliglaan.write_excel(boliglaan_path, boliglaan_cases)
+    branches = []
+    if OPUS_STAGE in pending_stages:
+        branches.append(run_opus)
+    if BOLIGLAAN_STAGE in pending_stages:
+        branches.append(run_boliglaan)
 
-    # Send results
-    opus_text = config.EMAIL_TEXT.replace("%SYSTEM%", "OPUS")
-    orchestrator_connection.log_info(f"Sending OPUS email to: {opus_receivers}")
-    common.send_email(opus_receivers, opus_name, opus_text, opus_path)
+    run_branches(branches, config.RUN_BRANCHES_CONCURRENTLY)
 
-    boliglaan_text = config.EMAIL_TEXT.replace("%SYSTEM%", "KMD Boliglån")
-    orchestrator_connection.log_info(f"Sending Boliglån email to: {boliglaan_receivers}")
-    common.send_email(boliglaan_receivers, boliglaan_name, boliglaan_text, boliglaan_path)
+    # Send results and mark the reported matches as sent
+    opus_text = config.EMAIL_TEXT.replace("%SYSTEM%", opus.SYSTEM_NAME)
+    orchestrator_connection.log_info(f"Sending OPUS email to: {attempt.opus_receivers}")
+    common.send_email(attempt.opus_receivers, opus_name, opus_text, opus_path)
+    sent_matches.mark_sent(config.SENT_MATCHES_DATABASE, opus.SYSTEM_NAME, today)
+
+    boliglaan_text = config.EMAIL_TEXT.replace("%SYSTEM%", kmd_boliglaan.SYSTEM_NAME)
+    orchestrator_connection.log_info(f"Sending Boliglån email to: {attempt.boliglaan_receivers}")
+    common.send_email(attempt.boliglaan_receivers, boliglaan_name, boliglaan_text, boliglaan_path)
+    sent_matches.mark_sent(config.SENT_MATCHES_DATABASE, kmd_boliglaan.SYSTEM_NAME, today)
 
     # Delete OPUS emails
-    opus.delete_emails(orchestrator_connection)
+    opus.delete_emails(orchestrator_connection, mail_client)
 
     itk_dev_event_log.emit(orchestrator_connection.process_name, "Cases loaded from Statstidende", len(cases))
-    itk_dev_event_log.emit(orchestrator_connection.process_name, "Opus cases found", len(opus_cases))
-    itk_dev_event_log.emit(orchestrator_connection.process_name, "Boliglån cases found", len(boliglaan_cases))
+
+
+def get_checkpoint_paths(today: date) -> dict[str, str]:
+    """Get the checkpoint file of each stage. A stage is done when its file exists.
+
+    Args:
+        today: The date of the run.
+
+    Returns:
+        A dict in the format: stage -> path
+    """
+    date_text = today.strftime('%d-%m-%Y')
+    return {
+        STATSTIDENDE_STAGE: f'cases {date_text}.pickle',
+        OPUS_STAGE: f"Opus Statstidende {date_text}.xlsx",
+        BOLIGLAAN_STAGE: f"Boliglån Statstidende {date_text}.xlsx"
+    }
+
+
+def get_pending_stages(now: datetime, reuse_lenders: bool) -> frozenset[str]:
+    """Find the stages that still have to run on the date of the attempt from the checkpoint files.
+    The KMD Boliglån export only has to run if the Boliglån stage is pending
+    and no lender snapshot can be reused.
+
+    Args:
+        now: The start time of the attempt.
+        reuse_lenders: Whether any snapshot younger than the max age in config can be reused.
+
+    Returns:
+        The names of the pending stages.
+    """
+    pending_stages = {stage for stage, path in get_checkpoint_paths(now.date()).items() if not os.path.isfile(path)}
+
+    if BOLIGLAAN_STAGE in pending_stages and not kmd_boliglaan.find_reusable_snapshot(reuse_lenders, now):
+        pending_stages.add(BOLIGLAAN_EXPORT_STAGE)
+
+    return frozenset(pending_stages)
+
+
+def run_branches(branches: list[Callable[[], None]], concurrently: bool) -> None:
+    """Run the branches of the process and wait for all of them to finish.
+    When run concurrently the last branch runs in the calling thread, since
+    KMD Boliglån is automated through COM, and the others run in worker threads.
+    A failing branch doesn't stop the others, so their workbooks are still saved
+    and skipped on the next attempt. The errors are raised when all branches are done.
+
+    Args:
+        branches: The branches to run.
+        concurrently: Whether to run the branches at the same time or one after the other.
+
+    Raises:
+        Exception: The error of the failing branch.
+        ExceptionGroup: The errors if more than one branch failed.
+    """
+    errors = []
+
+    def run(branch: Callable[[], None]) -> None:
+        try:
+            branch()
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            errors.append(exc)
+
+    if concurrently and len(branches) > 1:
+        with ThreadPoolExecutor(max_workers=len(branches) - 1) as executor:
+            for branch in branches[:-1]:
+                executor.submit(run, branch)
+            run(branches[-1])
+    else:
+        for branch in branches:
+            run(branch)
+
+    if len(errors) == 1:
+        raise errors[0]
+    if errors:
+        raise ExceptionGroup("More than one branch failed", errors)
@@ -2,17 +2,17 @@
 
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
 
-from robot_framework import config
+from robot_framework import config, process
 from robot_framework.sub_process import kmd_boliglaan
 
 
-def reset(orchestrator_connection: OrchestratorConnection) -> None:
+def reset(orchestrator_connection: OrchestratorConnection, attempt: process.Attempt) -> None:
     """Clean up, close/kill all programs and start them again. """
     orchestrator_connection.log_trace("Resetting.")
     clean_up(orchestrator_connection)
     close_all(orchestrator_connection)
     kill_all(orchestrator_connection)
-    open_all(orchestrator_connection)
+    open_all(orchestrator_connection, attempt)
 
 
 def clean_up(orchestrator_connection: OrchestratorConnection) -> None:
@@ -32,9 +32,15 @@ def kill_all(orchestrator_connection: OrchestratorConnection) -> None:
     kmd_boliglaan.kill_boliglaan()
 
 
-def open_all(orchestrator_connection: OrchestratorConnection) -> None:
+def open_all(orchestrator_connection: OrchestratorConnection, attempt: process.Attempt) -> None:
     """Open all programs used by the robot."""
     orchestrator_connection.log_trace("Opening all applications.")
+
+    # KMD Boliglån is slow to start, so it's only opened when the export has to run
+    if process.BOLIGLAAN_EXPORT_STAGE not in attempt.pending_stages:
+        orchestrator_connection.log_trace("Skipping KMD Boliglån. The lenders are already exported.")
+        return
+
     kmd_login = orchestrator_connection.get_credential(config.BOLIGLAAN_LOGIN)
 
     kmd_boliglaan.login(kmd_login.username, kmd_login.password)
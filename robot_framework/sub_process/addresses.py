@@ -0,0 +1,54 @@
+"""This module is responsible for parsing addresses into their parts.
+Addresses from Statstidende, OPUS and KMD Boliglån are compared on the parts
+parsed here, so the match keys are derived the same way on both sides.
+"""
+
+from functools import lru_cache
+import re
+
+from robot_framework.sub_process.records import Address
+
+ZIPCODE_PATTERN = re.compile(r"\b\d{4}\b")
+
+# The street is everything before the first digit and the house number is the rest, e.g. "3, 1. tv"
+STREET_PATTERN = re.compile(r"\s*(?P<street>\D*?)[\s,]*(?P<house_number>\d.*?)?[\s,]*$")
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=65536)
+def parse_address(address: str) -> Address:
+    """Parse an address in the format "street house number, zipcode city".
+    The zipcode is the last four-digit number in the address.
+    Many lenders share a building, so the parsed addresses are cached.
+
+    Args:
+        address: The full address.
+
+    Returns:
+        The parts of the address.
+    """
+    zipcode = city = ""
+
+    # Find all four-digit numbers and use the last one
+    zipcodes = list(ZIPCODE_PATTERN.finditer(address))
+    if zipcodes:
+        zipcode = zipcodes[-1].group()
+        city = address[zipcodes[-1].end():].strip(" ,")
+        address = address[:zipcodes[-1].start()]
+
+    parts = STREET_PATTERN.match(address)
+    return Address(parts["street"], parts["house_number"] or "", zipcode, city)
+
+
+def format_address(street: str, house_number: str, zipcode: str, city: str) -> str:
+    """Join the parts of an address into a full address that parse_address can split again.
+    Empty parts are left out.
+    """
+    return " ".join(part for part in (street, house_number, zipcode, city) if part)
+
+
+@lru_cache(maxsize=65536)
+def normalize_street(street: str) -> str:
+    """Normalize a street name for comparison. The case and extra whitespace are ignored."""
+    return WHITESPACE_PATTERN.sub(" ", street).strip().lower()
@@ -3,13 +3,87 @@
 from email.message import EmailMessage
 import smtplib
 import os
+from typing import Any, Callable, Iterable, Iterator, Sequence
+
+import openpyxl
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.filters import AutoFilter
+from openpyxl.worksheet.table import Table, TableColumn, TableStyleInfo
 
 from robot_framework import config
+from robot_framework.sub_process import addresses
+from robot_framework.sub_process.records import Address, Match, Person, StatstidendeCase
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is an optional dependency only used by Matcher.match_batch
+    np = None  # pylint: disable=invalid-name
+
+
+class AddressIndex:  # pylint: disable=too-few-public-methods
+    """An index of tvangsauktioner by zipcode and street.
+    The cases are keyed by the street and zipcode fields from Statstidende and the streets
+    are normalized, so looking up a street and zipcode is a single dict lookup.
+    Streets are compared in full, so multi-word street names only match the same street.
+    """
+
+    def __init__(self, tvangsauktioner: dict[Address, StatstidendeCase]):
+        self.index: dict[tuple[str, str], list[StatstidendeCase]] = {}
+
+        for address, case in tvangsauktioner.items():
+            street = addresses.normalize_street(address.street)
+            if address.zipcode and street:
+                self.index.setdefault((address.zipcode, street), []).append(case)
+
+    def find(self, street: str, zipcode: str) -> list[StatstidendeCase]:
+        """Find all tvangsauktioner on the given street and zipcode.
+
+        Args:
+            street: The street name.
+            zipcode: The zipcode.
+
+        Returns:
+            A list of matching cases.
+        """
+        return self.index.get((zipcode, addresses.normalize_street(street)), [])
+
 
+class NameIndex:  # pylint: disable=too-few-public-methods
+    """An index of gældssaneringer by birthdate and each word of the name on the case.
+    Looking up a birthdate and first name is a single dict lookup.
 
-def compare_addresses(address_a, street_b, zipcode_b) -> bool:
-    """Check if the given street and zipcode matches the address."""
-    return zipcode_b in address_a and street_b in address_a
+    The first name must match a whole word of the name case insensitively.
+    Substring matching (where "Ann" matches "Hanne") is available for parity with
+    the old search by setting substring_match.
+    """
+
+    def __init__(self, gaeldssaneringer: dict[str, list[StatstidendeCase]], substring_match: bool = False):
+        self.gaeldssaneringer = gaeldssaneringer
+        self.substring_match = substring_match
+        self.index: dict[tuple[str, str], list[StatstidendeCase]] = {}
+
+        for birthdate, cases in gaeldssaneringer.items():
+            for case in cases:
+                if not case.identifier:
+                    continue
+                for token in set(case.identifier.lower().split()):
+                    self.index.setdefault((birthdate, token), []).append(case)
+
+    def find(self, birthdate: str, first_name: str) -> list[StatstidendeCase]:
+        """Find all gældssaneringer on the given birthdate and first name.
+
+        Args:
+            birthdate: The birthdate in the format 'yyyy-mm-dd'.
+            first_name: The first name.
+
+        Returns:
+            A list of matching cases.
+        """
+        if self.substring_match:
+            return [case for case in self.gaeldssaneringer.get(birthdate, []) if first_name in case.identifier]
+
+        return self.index.get((birthdate, first_name.lower()), [])
 
 
 def get_birthdate(debitor_id: str) -> str:
@@ -38,6 +112,266 @@ def get_birthdate(debitor_id: str) -> str:
     return f"{year}-{month}-{day}"
 
 
+class Matcher:  # pylint: disable=too-few-public-methods
+    """Match debitors and lenders against the Statstidende cases.
+    The indexes are built once, so the same matcher can be used for both OPUS and KMD Boliglån.
+
+    The cases are searched in the following ways:
+    - Dødsboer on cpr.
+    - Konkursboer on cvr.
+    - Gældssaneringer on birthdate and first name.
+    - Tvangsauktioner on street and zipcode.
+    """
+
+    def __init__(self, cases: tuple[dict], substring_match: bool = False):
+        """Build the indexes of the given cases.
+
+        Args:
+            cases: The four dicts (dødsboer, gældssaneringer, konkursboer, tvangsauktioner).
+            substring_match: Whether to match gældssaneringer on substrings of the name. See NameIndex.
+        """
+        self.doedsboer, gaeldssaneringer, self.konkursboer, tvangsauktioner = cases
+        self.name_index = NameIndex(gaeldssaneringer, substring_match)
+        self.address_index = AddressIndex(tvangsauktioner)
+        self._batch_keys = None
+
+    def match(self, people: Iterable[Person], include_konkursboer: bool = True) -> Iterator[Match]:
+        """Find all cases that could have relevance for the given people.
+
+        Args:
+            people: The normalized debitors or lenders to match.
+            include_konkursboer: Whether to search konkursboer on cvr.
+
+        Yields:
+            The matches in the order of the people.
+        """
+        for person in people:
+            # Search dødsboer on cpr
+            if person.person_id in self.doedsboer:
+                yield Match(person.record, self.doedsboer[person.person_id])
+
+            # Search konkursboer on cvr
+            if include_konkursboer and person.person_id in self.konkursboer:
+                yield Match(person.record, self.konkursboer[person.person_id])
+
+            # Search gældssaneringer on birthdate and first name
+            if person.birthdate and person.first_name:
+                for case in self.name_index.find(person.birthdate, person.first_name):
+                    yield Match(person.record, case)
+
+            # Search tvangsauktioner on street and zipcode
+            if person.street and person.zipcode:
+                for case in self.address_index.find(person.street, person.zipcode):
+                    yield Match(person.record, case)
+
+    def match_batch(self, records: Sequence, to_person: Callable[[Any], Person], *, person_ids: Sequence[str],
+                    streets: Sequence[str], zipcodes: Sequence[str], include_konkursboer: bool = True) -> Iterator[Match]:
+        """Find all cases that could have relevance for the given records using numpy.
+
+        The ids, birthdates and addresses of all records are checked against the indexes at once.
+        Cpr and cvr numbers are compared as integers and the birthdates are derived from them
+        arithmetically. Only the records that could match are converted with to_person and
+        passed to match, so the matches are the same and in the same order as from match.
+
+        Requires numpy. See batch_matching_available.
+
+        Args:
+            records: The debitors or lenders to match.
+            to_person: The function that normalizes a record to a Person.
+            person_ids: The cpr or cvr of each record.
+            streets: The street of each record.
+            zipcodes: The zipcode of each record.
+            include_konkursboer: Whether to search konkursboer on cvr.
+
+        Yields:
+            The matches in the order of the records.
+        """
+        if self._batch_keys is None:
+            self._batch_keys = _BatchKeys(self)
+
+        keys = self._batch_keys
+        is_number, numbers = _to_numbers(_to_array(person_ids))
+
+        # Ids that aren't plain numbers are always looked up, so nothing is missed
+        candidates = ~is_number | np.isin(numbers, keys.doedsboer)
+        if include_konkursboer:
+            candidates |= np.isin(numbers, keys.konkursboer)
+
+        is_cpr = is_number & (numbers % _NUMBER_BASE == 10)
+        candidates |= is_cpr & np.isin(_to_birthdates(numbers // _NUMBER_BASE), keys.birthdates)
+
+        # Only the streets on a zipcode with a tvangsauktion are normalized
+        zipcodes = _to_array(zipcodes)
+        on_zipcode = np.flatnonzero(np.isin(zipcodes, keys.zipcodes))
+        if on_zipcode.size:
+            on_street = _map_distinct(addresses.normalize_street, _to_array(streets)[on_zipcode])
+            address_keys = np.char.add(np.char.add(zipcodes[on_zipcode], _KEY_SEPARATOR), on_street)
+            candidates[on_zipcode[np.isin(address_keys, keys.addresses)]] = True
+
+        people = (to_person(records[i]) for i in np.flatnonzero(candidates).tolist())
+        yield from self.match(people, include_konkursboer)
+
+
+class _BatchKeys:  # pylint: disable=too-few-public-methods
+    """The keys of a matcher's indexes as numpy arrays for Matcher.match_batch."""
+
+    def __init__(self, matcher: Matcher):
+        self.doedsboer = _to_numbers(_to_array(list(matcher.doedsboer)))[1]
+        self.konkursboer = _to_numbers(_to_array(list(matcher.konkursboer)))[1]
+
+        birthdates = [birthdate.replace("-", "") for birthdate in matcher.name_index.gaeldssaneringer]
+        self.birthdates = np.array([int(birthdate) for birthdate in birthdates if birthdate.isdigit()], dtype=np.int64)
+
+        self.zipcodes = _to_array([zipcode for zipcode, _ in matcher.address_index.index])
+        self.addresses = _to_array([f"{zipcode}{_KEY_SEPARATOR}{street}" for zipcode, street in matcher.address_index.index])
+
+
+def batch_matching_available() -> bool:
+    """Check if numpy is installed so Matcher.match_batch can be used."""
+    return np is not None
+
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    """Split an iterable into lists of the given size. The last list may be shorter.
+
+    Args:
+        items: The items to split.
+        size: The number of items in each list.
+
+    Yields:
+        The lists of items.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+# The separator of the address keys in Matcher.match_batch. It can't occur in a street or zipcode
+_KEY_SEPARATOR = "\x1f"
+
+# Numbers are encoded as value * _NUMBER_BASE + length, so "0012" and "12" are different keys
+_NUMBER_BASE = 16
+_MAX_NUMBER_LENGTH = 10
+
+
+def _to_array(values: Sequence) -> "np.ndarray":
+    """Convert a column to a numpy string array.
+    Values that aren't strings are converted with str. That can only make more records
+    candidates in Matcher.match_batch, since match checks them again.
+    """
+    return np.array(values, dtype=str)
+
+
+def _to_numbers(values: "np.ndarray") -> tuple["np.ndarray", "np.ndarray"]:
+    """Encode strings of up to ten ascii digits as integers.
+
+    Args:
+        values: The strings to encode.
+
+    Returns:
+        A mask of the values that are numbers and the encoded numbers. Other values are encoded as -1.
+    """
+    lengths = np.char.str_len(values)
+    digits = values.astype(f"U{_MAX_NUMBER_LENGTH}").view(np.uint32).reshape(-1, _MAX_NUMBER_LENGTH).astype(np.int64) - ord("0")
+    positions = np.arange(_MAX_NUMBER_LENGTH) < lengths[:, None]
+
+    is_number = (lengths > 0) & (lengths <= _MAX_NUMBER_LENGTH) & np.all(~positions | ((digits >= 0) & (digits <= 9)), axis=1)
+    value = np.zeros(len(values), dtype=np.int64)
+    for column in range(_MAX_NUMBER_LENGTH):
+        value = np.where(positions[:, column], value * 10 + digits[:, column], value)
+
+    return is_number, np.where(is_number, value * _NUMBER_BASE + lengths, -1)
+
+
+def _to_birthdates(cprs: "np.ndarray") -> "np.ndarray":
+    """Derive the birthdates of cpr numbers like get_birthdate, but as integers in the format yyyymmdd."""
+    day = cprs // 10**8
+    month = cprs // 10**6 % 100
+    year = cprs // 10**4 % 100
+    year += np.where(year < 20, 2000, 1900)
+    return year * 10000 + month * 100 + day
+
+
+def _map_distinct(function: Callable[[str], str], values: "np.ndarray") -> "np.ndarray":
+    """Apply a function to each distinct value of a string array instead of to every value."""
+    distinct, inverse = np.unique(values, return_inverse=True)
+    return np.array([function(value) for value in distinct.tolist()], dtype=str)[inverse.reshape(-1)]
+
+
+class ExcelWriter:
+    """Write rows to the sheets of an Excel file as they are produced.
+    The workbook is write-only, so rows are streamed to disk instead of kept in memory.
+    When the writer is closed each sheet with any rows gets a table.
+    Use the writer as a context manager. The file is only saved if no error occurs.
+    """
+
+    def __init__(self, path: str, sheets: dict[str, tuple[str]]):
+        """Create the workbook and write the header of each sheet.
+
+        Args:
+            path: Where to save the excel file.
+            sheets: A dict in the format: sheet name -> column names
+        """
+        self.path = path
+        self.headers = sheets
+        self.wb = openpyxl.Workbook(write_only=True)
+        self.sheets = {}
+        self.row_counts = {}
+
+        for name, header in sheets.items():
+            ws = self.wb.create_sheet(name)
+            ws.append(header)
+            self.sheets[name] = ws
+            self.row_counts[name] = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.save()
+
+    def append(self, sheet_name: str, row: tuple) -> None:
+        """Append a row to the given sheet."""
+        self.sheets[sheet_name].append(row)
+        self.row_counts[sheet_name] += 1
+
+    def count_rows(self, exclude: Iterable[str] = ()) -> int:
+        """Count the rows appended to all sheets except the excluded ones. The headers aren't counted."""
+        return sum(count for name, count in self.row_counts.items() if name not in exclude)
+
+    def save(self) -> None:
+        """Add tables to the sheets and save the file."""
+        for name, ws in self.sheets.items():
+            row_count = self.row_counts[name]
+            if row_count == 0:
+                continue
+
+            header = self.headers[name]
+            # The table includes the header row
+            ref = f"A1:{get_column_letter(len(header))}{row_count + 1}"
+
+            # Write-only sheets can't read the header cells, so the table columns are given here.
+            # Table names can't contain spaces.
+            table = Table(
+                displayName=name.replace(" ", "_"),
+                ref=ref,
+                tableColumns=[TableColumn(id=i, name=column_name) for i, column_name in enumerate(header, start=1)],
+                autoFilter=AutoFilter(ref=ref)
+            )
+            table.tableStyleInfo = TableStyleInfo(name="TableStyleMedium9", showFirstColumn=False, showLastColumn=False, showRowStripes=True, showColumnStripes=True)
+            ws.add_table(table)
+
+        self.wb.save(self.path)
+        self.wb.close()
+
+
 def send_email(to_address: str | list[str], subject: str, body: str, attachment_path: str) -> None:
     """Send an email with an attachment using SMTP.
 
@@ -1,19 +1,66 @@
 """This module is responsible for all logic concerning KMD Boliglån"""
 
 import csv
+from datetime import date, datetime, timedelta
 import os
 import time
-import re
 import subprocess
+from typing import Any, Callable, Iterable, Iterator, TextIO
 
 from _ctypes import COMError
-import openpyxl
-from openpyxl.worksheet.table import Table, TableStyleInfo
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
 import uiautomation
 from itk_dev_shared_components.misc import file_util
 
-from robot_framework.sub_process import common
+from robot_framework import config
+from robot_framework.sub_process import addresses, common, sent_matches
+from robot_framework.sub_process.records import BoliglaanLender, Match, Person
+
+SYSTEM_NAME = "KMD Boliglån"
+
+# The columns of the lender data in the csv export
+CPR_COLUMN = 1
+NAME_COLUMN = 2
+ADDRESS_COLUMN = 5
+
+# The header row is found by these words in the titles of the lender columns (case is ignored)
+HEADER_TITLES = {
+    CPR_COLUMN: "cpr",
+    NAME_COLUMN: "navn",
+    ADDRESS_COLUMN: "adresse"
+}
+
+# The header row is searched for in this many lines at the top of the csv export.
+# If it isn't found the data is assumed to start after the fixed number of metadata lines.
+HEADER_SEARCH_LINES = 50
+METADATA_LINES = 12
+
+SNAPSHOT_TIME_FORMAT = "%Y-%m-%d %H-%M-%S"
+
+# The seconds between checks when waiting for KMD Boliglån
+WAIT_INTERVAL = 0.5
+
+# The check boxes to select in "Udsøg lånesager"
+LAANESTATUS = (
+    "Bevilget",
+    "Udbetalt",
+    "Afvikling - frivillig",
+    "Afvikling - 5 års løbetid"
+)
+
+LAANETYPE = (
+    "Pligtlån 5 års løbetid §56, §57",
+    "Pligtlån sanering §54",
+    "Pligtlån pensionister §54",
+    "Pligtlån enkeltværelse §54",
+    "Pligtlån genhusning §54",
+    "Pligtlån ældrebolig §54",
+    "Flygtningelån 100% 5 års løbetid §66, §67",
+    "Flygtningelån 100% sanering §66, §67",
+    "Flygtningelån 100% pensionister §66, §67",
+    "Flygtninglån 50% 5 års løbetid §68",
+    "Kommune lån §59"
+)
 
 
 def login(username: str, password: str):
@@ -23,214 +70,344 @@ def login(username: str, password: str):
     kmd_logon = uiautomation.WindowControl(AutomationId="MainLogonWindow", searchDepth=1)
 
     # Wait for logon window to load
-    for _ in range(5):
-        try:
-            if len(kmd_logon.ComboBoxControl(AutomationId="UserPwComboBoxCics").GetSelectionPattern().GetSelection()) == 1:
-                break
-        except LookupError:
-            pass
-        time.sleep(1)
+    cics = kmd_logon.ComboBoxControl(AutomationId="UserPwComboBoxCics")
+    wait_until(
+        lambda: kmd_logon.Exists(0, 0) and cics.Exists(0, 0) and len(cics.GetSelectionPattern().GetSelection()) == 1,
+        config.KMD_WINDOW_TIMEOUT, f"KMD Logon didn't load within {config.KMD_WINDOW_TIMEOUT} seconds"
+    )
 
     kmd_logon.EditControl(AutomationId="UserPwTextBoxUserName").GetValuePattern().SetValue(username)
     kmd_logon.EditControl(AutomationId="UserPwPasswordBoxPassword").GetValuePattern().SetValue(password)
     kmd_logon.ButtonControl(AutomationId="UserPwLogonButton").GetInvokePattern().Invoke()
 
     boliglaan = uiautomation.WindowControl(Name="KMD Boliglån", searchDepth=1)
-    if not boliglaan.Exists(maxSearchSeconds=30):
-        raise RuntimeError("Boliglån didn't appear within 30 seconds")
+    if not boliglaan.Exists(maxSearchSeconds=config.KMD_WINDOW_TIMEOUT):
+        raise RuntimeError(f"Boliglån didn't appear within {config.KMD_WINDOW_TIMEOUT} seconds")
 
 
-def load_lenders() -> list[tuple[str]]:
+def load_lenders() -> str:
     """Go through KMD Boliglån and save a list of lenders based on filter
-    criteria. Read the list and return the data.
+    criteria. Return the path of the saved list.
     """
-    laanestatus = [
-        "Bevilget",
-        "Udbetalt",
-        "Afvikling - frivillig",
-        "Afvikling - 5 års løbetid"
-    ]
-
-    laanetype = [
-        "Pligtlån 5 års løbetid §56, §57",
-        "Pligtlån sanering §54",
-        "Pligtlån pensionister §54",
-        "Pligtlån enkeltværelse §54",
-        "Pligtlån genhusning §54",
-        "Pligtlån ældrebolig §54",
-        "Flygtningelån 100% 5 års løbetid §66, §67",
-        "Flygtningelån 100% sanering §66, §67",
-        "Flygtningelån 100% pensionister §66, §67",
-        "Flygtninglån 50% 5 års løbetid §68",
-        "Kommune lån §59"
-    ]
-
     # Open search window
     boliglaan = uiautomation.WindowControl(Name="KMD Boliglån", searchDepth=1)
     boliglaan.SendKeys("{Ctrl}b")
 
-    # Check boxes and search
     laanesager_window = boliglaan.WindowControl(Name="Udsøg lånesager", searchDepth=1)
+    if not laanesager_window.Exists(maxSearchSeconds=config.KMD_WINDOW_TIMEOUT):
+        raise RuntimeError(f"Udsøg lånesager didn't appear within {config.KMD_WINDOW_TIMEOUT} seconds")
 
-    for control, _ in uiautomation.WalkControl(laanesager_window):
-        if isinstance(control, uiautomation.CheckBoxControl) and control.Name in laanestatus+laanetype:
-            control.GetTogglePattern().Toggle(waitTime=0)
+    # Check boxes and search. Boxes that are already checked are left as they are.
+    for check_box in find_check_boxes(laanesager_window, LAANESTATUS + LAANETYPE).values():
+        toggle = check_box.GetTogglePattern()
+        if toggle.ToggleState != uiautomation.ToggleState.On:
+            toggle.Toggle(waitTime=0)
 
     laanesager_window.ButtonControl(Name="Søg").GetInvokePattern().Invoke()
 
-    # Wait for search
+    # Wait for search and press save
     save_button = boliglaan.GroupControl(AutomationId="SagerLayoutPanel", searchDepth=4).ButtonControl(Name="Save", searchDepth=3)
-    for _ in range(5):
-        try:
-            save_button.GetInvokePattern().Invoke()
-            break
-        except (AttributeError, COMError):
-            pass
-    else:
-        raise TimeoutError("Boliglån result didn't appear after a long time")
+    wait_until(
+        lambda: save_button.Exists(0, 0) and invoke(save_button),
+        config.KMD_SEARCH_TIMEOUT, f"Boliglån result didn't appear within {config.KMD_SEARCH_TIMEOUT} seconds"
+    )
 
     # Save file and read it
     folder = os.getcwd()
     path = os.path.join(os.getcwd(), "udtræk.csv")
     file_util.handle_save_dialog(path)
     file_util.wait_for_download(folder=folder, file_name="udtræk", file_extension=".csv")
-    time.sleep(2)  # An extra wait for the file to be ready
+    wait_until(lambda: is_file_ready(path), config.KMD_FILE_TIMEOUT, f"The export wasn't saved within {config.KMD_FILE_TIMEOUT} seconds")
+
+    return path
+
+
+def find_check_boxes(parent: uiautomation.Control, names: Iterable[str]) -> dict[str, uiautomation.Control]:
+    """Find check boxes by name in a single walk of the control tree.
+    The walk stops as soon as all the check boxes have been found.
+
+    Args:
+        parent: The control to search under.
+        names: The names of the check boxes.
+
+    Returns:
+        The check boxes by name in the order of the names.
+
+    Raises:
+        LookupError: If any of the check boxes doesn't exist.
+    """
+    names = tuple(names)
+    remaining = set(names)
+    found = {}
+
+    for control, _ in uiautomation.WalkControl(parent):
+        if isinstance(control, uiautomation.CheckBoxControl) and control.Name in remaining:
+            found[control.Name] = control
+            remaining.remove(control.Name)
+            if not remaining:
+                break
 
-    return read_csv(path)
+    if remaining:
+        raise LookupError(f"Couldn't find the check boxes in {parent.Name}: {', '.join(sorted(remaining))}")
 
+    return {name: found[name] for name in names}
 
-def read_csv(file_name: str) -> list[tuple[str]]:
-    """Read a csv file from KMD Boliglån and extract
+
+def wait_until(condition: Callable[[], Any], timeout: float, error_message: str) -> Any:
+    """Check a condition until it's true or the timeout runs out.
+    Errors from controls that don't exist or aren't ready yet count as false.
+
+    Args:
+        condition: A function returning a truthy value when the wait is over.
+        timeout: The number of seconds to wait.
+        error_message: The message of the error raised on timeout.
+
+    Returns:
+        The truthy value returned by the condition.
+
+    Raises:
+        TimeoutError: If the condition isn't true within the timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            result = condition()
+            if result:
+                return result
+        except (AttributeError, COMError, LookupError, OSError):
+            pass
+
+        if time.monotonic() >= deadline:
+            raise TimeoutError(error_message)
+        time.sleep(WAIT_INTERVAL)
+
+
+def invoke(control: uiautomation.Control) -> bool:
+    """Invoke a control and return True. Raises an error if the control can't be invoked yet."""
+    control.GetInvokePattern().Invoke(waitTime=0)
+    return True
+
+
+def is_file_ready(path: str) -> bool:
+    """Check if a file has content and isn't locked by the program writing it."""
+    if not os.path.isfile(path):
+        return False
+
+    # Opening the file for writing fails while another program has it open
+    with open(path, 'ab'):
+        return os.path.getsize(path) > 0
+
+
+def read_csv(file_name: str, orchestrator_connection: OrchestratorConnection) -> Iterator[Person]:
+    """Read a csv file from KMD Boliglån one lender at a time and extract
     cpr, name and address for each lender.
+    The keys the lenders are matched on are derived as each row is read.
+
+    Args:
+        file_name: The path of the csv file.
+        orchestrator_connection: The connection to OpenOrchestrator.
+
+    Yields:
+        The lenders as Persons.
     """
-    lenders = []
-    with open(file_name, encoding='ansi') as file:
-        # Skip first 12 rows (Meta data)
-        for _ in range(12):
-            next(file)
-
-        # Read data
-        reader = csv.reader(file, delimiter=';')
-        for row in reader:
-            lender = (
-                row[1],  # cpr
-                row[2],  # Name
-                row[5]   # Address
-            )
-            lenders.append(lender)
-
-    if len(lenders) == 0:
+    lender_count = 0
+
+    # The export is written by a Windows program in the Windows-1252 code page
+    with open(file_name, encoding='cp1252', newline='') as file:
+        skip_metadata(file, orchestrator_connection)
+
+        for row in csv.reader(file, delimiter=';'):
+            # Skip empty lines
+            if len(row) <= ADDRESS_COLUMN:
+                continue
+
+            lender_count += 1
+            yield normalize_lender(BoliglaanLender(
+                cpr=row[CPR_COLUMN],
+                name=row[NAME_COLUMN],
+                address=row[ADDRESS_COLUMN]
+            ))
+
+    orchestrator_connection.log_info(f"Lånere i boliglån: {lender_count}")
+    if lender_count == 0:
         raise RuntimeError("Found no lenders from KMD Boliglån")
 
-    return lenders
+
+def skip_metadata(file: TextIO, orchestrator_connection: OrchestratorConnection) -> None:
+    """Move the csv file past the meta data at the top, so the next line is the first data row.
+    The data starts after the header row, which is found by the titles in HEADER_TITLES.
+    The lines are read as plain text and not as csv, so a stray quote in the meta data can't hide the header.
+    If the header isn't found the first METADATA_LINES lines are skipped instead.
+
+    Args:
+        file: The csv file opened at the start.
+        orchestrator_connection: The connection to OpenOrchestrator.
+    """
+    for _ in range(HEADER_SEARCH_LINES):
+        line = file.readline()
+        if not line:
+            break
+
+        if is_header(line.rstrip("\r\n").split(";")):
+            return
+
+    orchestrator_connection.log_info(f"Couldn't find the header row in the KMD Boliglån export. Skipping the first {METADATA_LINES} lines instead.")
+    file.seek(0)
+    for _ in range(METADATA_LINES):
+        file.readline()
 
 
-def find_relevant_cases(in_cases: list[dict], orchestrator_connection: OrchestratorConnection) -> list[tuple[str]]:
+def is_header(cells: list[str]) -> bool:
+    """Check if a line of the csv file split into cells is the header of the lender data."""
+    return len(cells) > max(HEADER_TITLES) and all(title in cells[column].lower() for column, title in HEADER_TITLES.items())
+
+
+def find_relevant_cases(matcher: common.Matcher, orchestrator_connection: OrchestratorConnection, reuse_lenders: bool, now: datetime) -> Iterator[Match]:
     """Find all Statstidende cases that could have relevance for lenders in KMD Boliglån.
+    The lenders are exported from KMD Boliglån unless a recent enough snapshot exists.
 
     Args:
-        in_cases: A list of Statstidende cases.
+        matcher: The matcher with the Statstidende cases.
+        orchestrator_connection: The connection to OpenOrchestrator.
+        reuse_lenders: Whether to reuse any snapshot younger than LENDER_SNAPSHOT_MAX_AGE_HOURS
+            instead of only snapshots from today.
+        now: The start time of the attempt that snapshots are compared to.
 
     Returns:
-        A list of relevant cases.
+        A generator of the relevant cases.
     """
-    doedsboer, gaeldssaneringer, _, tvangsauktioner = in_cases
-
     orchestrator_connection.log_info("Finder lånere i Boliglån.")
-    lenders = load_lenders()
-    orchestrator_connection.log_info(f"Lånere i boliglån: {len(lenders)}")
 
-    out_cases = []
+    path = find_reusable_snapshot(reuse_lenders, now)
+    if path:
+        orchestrator_connection.log_info(f"Using lender snapshot: {path}")
+    else:
+        path = save_lender_snapshot(load_lenders(), datetime.now())
 
-    for lender in lenders:
-        cpr = lender[0]
-        name = lender[1]
-        first_name = name.split()[0]
-        address = lender[2]
-        street = address.split()[0]
-        zipcode = get_zipcode(address)
-        birthdate = common.get_birthdate(cpr)
+    return matcher.match(read_csv(path, orchestrator_connection), include_konkursboer=False)
 
-        # Search dødsboer on cpr
-        if cpr in doedsboer:
-            out_cases.append((lender, doedsboer[cpr]))
 
-        # Search gældssaneringer on birthdate and first name
-        if birthdate in gaeldssaneringer:
-            for case in gaeldssaneringer[birthdate]:
-                if first_name in case[0]:
-                    out_cases.append((lender, case))
+def find_reusable_snapshot(reuse_lenders: bool, now: datetime) -> str | None:
+    """Find a lender snapshot that can be used instead of a new export.
 
-        # Search tvangsauktioner on street and zipcode
-        if street and zipcode:
-            for address in tvangsauktioner:
-                if common.compare_addresses(address, street, zipcode):
-                    out_cases.append((lender, tvangsauktioner[address]))
+    Args:
+        reuse_lenders: Whether to reuse any snapshot younger than LENDER_SNAPSHOT_MAX_AGE_HOURS
+            instead of only snapshots from today.
+        now: The time to count the age of the snapshots from.
 
-    return out_cases
+    Returns:
+        The path of the snapshot or None if there is none.
+    """
+    if reuse_lenders:
+        return find_lender_snapshot(now - timedelta(hours=config.LENDER_SNAPSHOT_MAX_AGE_HOURS))
 
+    return find_lender_snapshot(datetime.combine(now.date(), datetime.min.time()))
 
-def get_zipcode(address: str) -> str:
-    """Extract the zipcode from an address string.
+
+def find_lender_snapshot(oldest: datetime) -> str | None:
+    """Find the newest lender snapshot taken after the given time.
 
     Args:
-        address: The full address.
+        oldest: The oldest time a snapshot can be from.
 
     Returns:
-        The zipcode from the address. If none is found '9999' is returned.
+        The path of the snapshot or None if there is none.
     """
-    # Use regular expressions to find all four-digit numbers
-    pattern = r"\b\d{4}\b"
-    matches = re.findall(pattern, address)
+    if not os.path.isdir(config.LENDER_SNAPSHOT_DIR):
+        return None
+
+    # File names end with the time the snapshot was taken which sorts as a string
+    snapshots = sorted(file_name for file_name in os.listdir(config.LENDER_SNAPSHOT_DIR) if file_name.endswith(".csv"))
+    if snapshots and _get_snapshot_time(snapshots[-1]) >= oldest:
+        return os.path.join(config.LENDER_SNAPSHOT_DIR, snapshots[-1])
 
-    if matches:
-        postal_code = matches[-1]  # Get the last occurrence
-        return postal_code
+    return None
 
-    return '9999'
 
+def save_lender_snapshot(path: str, now: datetime) -> str:
+    """Move an export from KMD Boliglån to the snapshot folder
+    and delete snapshots older than LENDER_SNAPSHOT_MAX_AGE_HOURS.
 
-# pylint: disable=R0801
-def write_excel(path: str, cases: tuple[tuple[str]]) -> None:
+    Args:
+        path: The path of the export.
+        now: The time the export was taken.
+
+    Returns:
+        The path of the snapshot.
+    """
+    os.makedirs(config.LENDER_SNAPSHOT_DIR, exist_ok=True)
+    oldest = now - timedelta(hours=config.LENDER_SNAPSHOT_MAX_AGE_HOURS)
+
+    for file_name in os.listdir(config.LENDER_SNAPSHOT_DIR):
+        if file_name.endswith(".csv") and _get_snapshot_time(file_name) < oldest:
+            os.remove(os.path.join(config.LENDER_SNAPSHOT_DIR, file_name))
+
+    snapshot_path = os.path.join(config.LENDER_SNAPSHOT_DIR, f"udtræk {now.strftime(SNAPSHOT_TIME_FORMAT)}.csv")
+    os.replace(path, snapshot_path)
+    return snapshot_path
+
+
+def _get_snapshot_time(file_name: str) -> datetime:
+    """Get the time a snapshot was taken from its file name."""
+    return datetime.strptime(file_name.removeprefix("udtræk ").removesuffix(".csv"), SNAPSHOT_TIME_FORMAT)
+
+
+def normalize_lender(lender: BoliglaanLender) -> Person:
+    """Derive the keys a lender is matched on.
+
+    Args:
+        lender: The lender from KMD Boliglån.
+
+    Returns:
+        The lender as a Person.
+    """
+    first_name = lender.name.split()[0] if lender.name else ""
+    address = addresses.parse_address(lender.address)
+    return Person(
+        record=lender,
+        person_id=lender.cpr,
+        first_name=first_name,
+        street=address.street,
+        zipcode=address.zipcode,
+        birthdate=common.get_birthdate(lender.cpr)
+    )
+
+
+def write_excel(path: str, cases: Iterable[Match], report_date: date) -> int:
     """Write the given cases to an excel file on the given path.
+    Each case is written to the sheet of its category as it is read.
+    Only matches that haven't been sent on an earlier report are included unless
+    INCLUDE_PREVIOUSLY_REPORTED is set in config. The new matches are added to the ledger as pending.
 
     Args:
         path: Where to save the excel file.
-        cases: A tuple of cases in the format:
-            ((Debitor), (Case)) = ((fp, id, fornavn, efternavn, gade, husnr, postnummer, by), (X, Type, Sagsnummer, dato))
+        cases: The matches between Boliglån lenders and Statstidende cases.
+        report_date: The date of the report.
+
+    Returns:
+        The number of new matches written to the file. Previously reported matches aren't counted.
     """
-    # Cases = ((Debitor),(Case)) = ((cpr, navn, adresse),(X, Type, Sagsnummer, dato))
-    wb = openpyxl.Workbook()
-    doedsboer_sheet = wb.active
-    doedsboer_sheet.title = "Dødsboer"
-    gaeldssaneringer_sheet = wb.create_sheet("Gældssaneringer")
-    tvangsauktioner_sheet = wb.create_sheet("Tvangsauktioner")
-
-    doedsboer_sheet.append(("CPR", "Navn", "Adresse", "CPR på Sag", "Type", "Sagsnummer", "Sagsdato"))
-    gaeldssaneringer_sheet.append(("CPR", "Navn", "Adresse", "Navn på sag", "Type", "Sagsnummer", "Sagsdato"))
-    tvangsauktioner_sheet.append(("CPR", "Navn", "Adresse", "Adresse på sag", "Type", "Sagsnummer", "Sagsdato"))
-
-    for case in cases:
-        case_type = case[1][1]
-        data = list(case[0]) + list(case[1])
-
-        if case_type.startswith("Dødsboer"):
-            doedsboer_sheet.append(data)
-        elif case_type.startswith("Gældssanering"):
-            gaeldssaneringer_sheet.append(data)
-        elif case_type.startswith("Tvangsauktioner"):
-            tvangsauktioner_sheet.append(data)
-
-    for ws in wb:
-        dim = ws.dimensions
-        if dim == 'A1:G1':
-            continue
-        table = Table(displayName=ws.title, ref=dim)
-        table.tableStyleInfo = TableStyleInfo(name="TableStyleMedium9", showFirstColumn=False, showLastColumn=False, showRowStripes=True, showColumnStripes=True)
-        ws.add_table(table)
-
-    wb.save(path)
-    wb.close()
+    sheets = {
+        "Dødsboer": ("CPR", "Navn", "Adresse", "CPR på Sag", "Type", "Sagsnummer", "Sagsdato"),
+        "Gældssaneringer": ("CPR", "Navn", "Adresse", "Navn på sag", "Type", "Sagsnummer", "Sagsdato"),
+        "Tvangsauktioner": ("CPR", "Navn", "Adresse", "Adresse på sag", "Type", "Sagsnummer", "Sagsdato")
+    }
+
+    if config.INCLUDE_PREVIOUSLY_REPORTED:
+        sheets[config.PREVIOUSLY_REPORTED_SHEET] = sent_matches.PREVIOUSLY_REPORTED_HEADER
+
+    # The ledger is saved before the workbook, so the new matches are never missing from it
+    with common.ExcelWriter(path, sheets) as writer:
+        with sent_matches.SentMatchLedger(config.SENT_MATCHES_DATABASE, SYSTEM_NAME, report_date) as ledger:
+            for lender, case in cases:
+                # The case type is in the format "Category - Message type"
+                sheet_name = case.case_type.split(" - ", 1)[0]
+                if sheet_name in sheets:
+                    sheet_name = ledger.report(lender.cpr, case.case_number, sheet_name)
+                    if sheet_name:
+                        writer.append(sheet_name, (*lender, *case))
+
+    return writer.count_rows(exclude=[config.PREVIOUSLY_REPORTED_SHEET])
 
 
 def kill_boliglaan():
@@ -1,180 +1,337 @@
 """This module is responsible for reading debitor data from emails in Outlook."""
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import date
+import hashlib
 from io import BytesIO
 import json
+import os
+import pickle
+import shutil
+from typing import Iterable, Iterator
 
-import openpyxl
-from openpyxl.worksheet.table import Table, TableStyleInfo
 from itk_dev_shared_components.graph import authentication, mail
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
 
 from robot_framework import config
-from robot_framework.sub_process import common
+from robot_framework.sub_process import common, sent_matches, xlsx_reader
+from robot_framework.sub_process.records import Match, OpusDebitor, Person
 
+SYSTEM_NAME = "OPUS"
 
-def load_debitors_from_emails(orchestrator_connection: OrchestratorConnection):
+
+def authorize_graph(orchestrator_connection: OrchestratorConnection) -> authentication.GraphAccess:
+    """Log in to the Graph API with the credentials in OpenOrchestrator.
+    The access refreshes its token by itself, so it can be used for the whole run.
+
+    Args:
+        orchestrator_connection: The connection to OpenOrchestrator.
+
+    Returns:
+        The access to the Graph API.
+    """
+    graph_creds = orchestrator_connection.get_credential(config.GRAPH_API)
+    return authentication.authorize_by_username_password(graph_creds.username, **json.loads(graph_creds.password))
+
+
+class MailClient:
+    """The folder in Outlook with the OPUS emails, accessed through the Graph API.
+    Everything the OPUS branch does with the emails goes through this class,
+    so it can be replaced by a local stand-in with the same methods.
+    The methods are called from several threads at once.
+    """
+
+    def __init__(self, graph_access: authentication.GraphAccess):
+        self.graph_access = graph_access
+
+    def get_emails(self) -> list[mail.Email]:
+        """Get the emails in "itk-rpa@mkb.aarhus.dk" - "Indbakke/Statstidende/Debitor Udtræk"."""
+        return mail.get_emails_from_folder("itk-rpa@mkb.aarhus.dk", "Indbakke/Statstidende/Debitor Udtræk", self.graph_access)
+
+    def list_attachments(self, email: mail.Email) -> list[mail.Attachment]:
+        """Get the attachments of an email without their content."""
+        return mail.list_email_attachments(email, self.graph_access)
+
+    def get_attachment_data(self, attachment: mail.Attachment) -> BytesIO:
+        """Download the content of an attachment."""
+        return mail.get_attachment_data(attachment, self.graph_access)
+
+    def delete_email(self, email: mail.Email) -> None:
+        """Delete an email."""
+        mail.delete_email(email, self.graph_access)
+
+
+def load_debitors_from_emails(orchestrator_connection: OrchestratorConnection, mail_client: MailClient) -> Iterator[OpusDebitor]:
     """Load debitor data from all the emails in
     "itk-rpa@mkb.aarhus.dk" - "Indbakke/Statstidende/Debitor Udtræk".
+    The attachments are downloaded in a thread pool and each sheet is parsed
+    in a process pool as soon as it has been downloaded.
+    Attachments parsed on an earlier attempt are loaded from the attachment cache instead.
+    Each parsed sheet is written to the cache before its debitors are yielded,
+    so only the sheets being parsed or yielded are held in memory.
+    The debitors of each sheet are yielded as soon as the sheet is ready,
+    so the same debitor can be yielded once per sheet it's in.
+
+    The process pool is started from the thread that runs the OPUS branch, which is a
+    worker thread when the branches run concurrently. The parse processes are spawned
+    as fresh interpreters on Windows and only get the attachment data, so no state
+    of the other threads is copied into them.
 
-    Returns:
-        A set of unique debitors in the format (fp, id, name, street, street_no, zip code)
+    Args:
+        orchestrator_connection: The connection to OpenOrchestrator.
+        mail_client: The client of the OPUS emails.
+
+    Yields:
+        The debitors of each sheet.
     """
     orchestrator_connection.log_info("Fetching data from OPUS emails")
 
-    graph_creds = orchestrator_connection.get_credential(config.GRAPH_API)
-    graph_access = authentication.authorize_by_username_password(graph_creds.username, **json.loads(graph_creds.password))
+    emails = mail_client.get_emails()
 
-    emails = mail.get_emails_from_folder("itk-rpa@mkb.aarhus.dk", "Indbakke/Statstidende/Debitor Udtræk", graph_access)
+    debitor_count = 0
 
-    debitors = set()
+    with ThreadPoolExecutor(max_workers=config.OPUS_DOWNLOAD_WORKERS) as download_pool, ProcessPoolExecutor(max_workers=config.OPUS_PARSE_WORKERS) as parse_pool:
+        downloads = {download_pool.submit(download_attachment, email, mail_client): email for email in emails}
+        parses = {}
 
-    for email in emails:
-        orchestrator_connection.log_info(f"Reading Email: {email.subject}")
-        att = mail.list_email_attachments(email, graph_access)[0]
-        excel_file = mail.get_attachment_data(att, graph_access)
-        read_sheet(excel_file, debitors)
-        excel_file.close()
-
-    orchestrator_connection.log_info(f"Debitore i Opus: {len(debitors)}")
-    if len(debitors) == 0:
+        for download in as_completed(downloads):
+            email = downloads[download]
+            cache_path, data = download.result()
+
+            if data is None:
+                orchestrator_connection.log_info(f"Reading cached Email: {email.subject}")
+                rows = load_cached_attachment(cache_path)
+                debitor_count += len(rows)
+                yield from (OpusDebitor._make(row) for row in rows)
+            else:
+                orchestrator_connection.log_info(f"Reading Email: {email.subject}")
+                parses[parse_pool.submit(parse_sheet, data)] = cache_path
+
+        for parse in as_completed(parses):
+            sheet_debitors = parse.result()
+            save_cached_attachment(parses.pop(parse), [tuple(debitor) for debitor in sheet_debitors])
+            debitor_count += len(sheet_debitors)
+            yield from sheet_debitors
+
+    orchestrator_connection.log_info(f"Debitore i Opus: {debitor_count}")
+    if debitor_count == 0:
         raise RuntimeError("Found no debitors from OPUS.")
-    return debitors
 
 
-def delete_emails(orchestrator_connection: OrchestratorConnection):
+def delete_emails(orchestrator_connection: OrchestratorConnection, mail_client: MailClient):
     """Delete the emails with debitors from Outlook.
 
     Args:
         orchestrator_connection: The connection to Orchestrator.
+        mail_client: The client of the OPUS emails.
     """
     orchestrator_connection.log_info("Deleting OPUS emails")
 
-    graph_creds = orchestrator_connection.get_credential(config.GRAPH_API)
-    graph_access = authentication.authorize_by_username_password(graph_creds.username, **json.loads(graph_creds.password))
+    emails = mail_client.get_emails()
 
-    emails = mail.get_emails_from_folder("itk-rpa@mkb.aarhus.dk", "Indbakke/Statstidende/Debitor Udtræk", graph_access)
     for email in emails:
         orchestrator_connection.log_info(f"Deleting Email: {email.subject}")
-        mail.delete_email(email, graph_access)
+        mail_client.delete_email(email)
 
+        # Evict the parsed attachments of the deleted email
+        shutil.rmtree(get_email_cache_dir(email.id), ignore_errors=True)
 
-def read_sheet(excel_file: BytesIO, debitors: set[str]) -> None:
-    """Read an Excel sheet and adds debitors to the given set.
+
+def download_attachment(email: mail.Email, mail_client: MailClient) -> tuple[str, bytes | None]:
+    """Download the first attachment of an email.
+    The attachment is identified by its id and size within the email.
+    If it's already in the attachment cache it isn't downloaded.
 
     Args:
-        excel_file: The excel file to read.
-        debitors: The set to add debitors to.
+        email: The email to download the attachment from.
+        mail_client: The client of the OPUS emails.
+
+    Returns:
+        The path of the attachment in the cache and its content or None if it's cached.
     """
-    wb = openpyxl.load_workbook(excel_file, read_only=True)
-    ws = wb.active
+    att = mail_client.list_attachments(email)[0]
+    cache_path = os.path.join(get_email_cache_dir(email.id), f"{_hash(f'{att.id}/{att.size}')}.pickle")
+    if os.path.isfile(cache_path):
+        return cache_path, None
 
-    rows = ws.values
-    column_names = next(rows)
-    aftaletype_index = column_names.index('RIM aftaletype')
+    excel_file = mail_client.get_attachment_data(att)
+    data = excel_file.getvalue()
+    excel_file.close()
+    return cache_path, data
 
-    for row in rows:
-        # Skip rows with aftaletype 'IN'
-        if row[aftaletype_index] != 'IN':
-            # Remove aftaletype column before adding to set
-            row = tuple(e for index, e in enumerate(row) if index != aftaletype_index)
-            debitors.add(row)
 
-    wb.close()
+def get_email_cache_dir(email_id: str) -> str:
+    """Get the folder of the cached attachments of an email."""
+    return os.path.join(config.OPUS_ATTACHMENT_CACHE_DIR, _hash(email_id))
 
 
-def find_relevant_cases(in_cases: list[dict], orchestrator_connection: OrchestratorConnection) -> list[tuple[str]]:
-    """Find all Statstidende cases that could have relevance for debitors in OPUS.
+def _hash(text: str) -> str:
+    """Turn a Graph id into a short name that is safe to use in a path."""
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def load_cached_attachment(cache_path: str) -> list[tuple]:
+    """Load the debitor rows of a parsed attachment from the cache.
 
     Args:
-        in_cases: A list of Statstidende cases.
+        cache_path: The path of the attachment in the cache.
 
     Returns:
-        A list of relevant cases.
+        The debitor rows.
     """
-    dødsboer, gældssaneringer, konkursboer, tvangsauktioner = in_cases
-    debitors = load_debitors_from_emails(orchestrator_connection)
+    with open(cache_path, 'rb') as file:
+        return pickle.load(file)
+
+
+def save_cached_attachment(cache_path: str, rows: list[tuple]) -> None:
+    """Save the debitor rows of a parsed attachment to the cache.
+
+    Args:
+        cache_path: The path of the attachment in the cache.
+        rows: The debitor rows.
+    """
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    # Write to a temporary file first so a failed write doesn't leave a broken entry behind
+    temp_path = cache_path + ".tmp"
+    with open(temp_path, 'wb') as file:
+        pickle.dump(rows, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, cache_path)
+
+
+def parse_sheet(data: bytes) -> set[OpusDebitor]:
+    """Parse the debitors in an Excel file.
+    This is run in a separate process, so the arguments and result are plain data.
+
+    Args:
+        data: The content of the Excel file.
+
+    Returns:
+        The set of debitors in the file.
+    """
+    debitors = set()
+    read_sheet(BytesIO(data), debitors)
+    return debitors
 
-    out_cases = []
 
-    for debitor in debitors:
-        debitor_id = debitor[1]
-        first_name = debitor[2].split()[0]
-        street = debitor[4]
-        # husnummer = row[5] Not used
-        zipcode = debitor[6]
-        birthdate = common.get_birthdate(debitor_id)
+def read_sheet(excel_file: BytesIO, debitors: set[OpusDebitor]) -> None:
+    """Read an Excel sheet and adds debitors to the given set.
+    Only the aftaletype column and the debitor columns are read from the sheet.
 
-        # Search on cpr
-        if debitor_id in dødsboer:
-            out_cases.append((debitor, dødsboer[debitor_id]))
+    Args:
+        excel_file: The excel file to read.
+        debitors: The set to add debitors to.
+    """
+    def select_columns(column_names: tuple) -> list[int]:
+        # Read the aftaletype first followed by the debitor columns without the aftaletype
+        aftaletype_index = column_names.index('RIM aftaletype')
+        debitor_columns = [index for index in range(len(column_names)) if index != aftaletype_index]
+        return [aftaletype_index] + debitor_columns[:len(OpusDebitor._fields)]
 
-        # Search on cvr
-        if debitor_id in konkursboer:
-            out_cases.append((debitor, konkursboer[debitor_id]))
+    rows = xlsx_reader.iter_rows(excel_file, select_columns)
+    next(rows)
 
-        # Search on birthdate and first name
-        if birthdate in gældssaneringer:
-            for case in gældssaneringer[birthdate]:
-                if first_name in case[0]:
-                    out_cases.append((debitor, case))
+    for aftaletype, *row in rows:
+        # Skip rows with aftaletype 'IN'
+        if aftaletype != 'IN':
+            debitors.add(OpusDebitor._make(row))
 
-        # Search on street and zipcode
-        if street and zipcode:
-            for address in tvangsauktioner:
-                if common.compare_addresses(address, street, zipcode):
-                    out_cases.append((debitor, tvangsauktioner[address]))
 
-    return out_cases
+def find_relevant_cases(matcher: common.Matcher, orchestrator_connection: OrchestratorConnection, mail_client: MailClient) -> Iterator[Match]:
+    """Find all Statstidende cases that could have relevance for debitors in OPUS.
+    The debitors are matched as they are read from the emails.
+    If numpy is installed and BATCH_MATCHING_CHUNK_SIZE is set they are matched
+    in chunks with Matcher.match_batch instead of one at a time.
+    Duplicate matches are removed, so a debitor found in more than one sheet
+    only gives each match once.
 
+    Args:
+        matcher: The matcher with the Statstidende cases.
+        orchestrator_connection: The connection to OpenOrchestrator.
+        mail_client: The client of the OPUS emails.
 
-def write_excel(path: str, cases: tuple[tuple[str]]):
+    Yields:
+        The relevant cases.
+    """
+    debitors = load_debitors_from_emails(orchestrator_connection, mail_client)
+
+    if config.BATCH_MATCHING_CHUNK_SIZE and common.batch_matching_available():
+        orchestrator_connection.log_info("Using batch matching")
+        matches = (
+            match
+            for chunk in common.chunked(debitors, config.BATCH_MATCHING_CHUNK_SIZE)
+            for match in matcher.match_batch(
+                chunk,
+                normalize_debitor,
+                person_ids=[debitor.debitor_id for debitor in chunk],
+                streets=[debitor.street for debitor in chunk],
+                zipcodes=[debitor.zipcode for debitor in chunk]
+            )
+        )
+    else:
+        matches = matcher.match(normalize_debitor(debitor) for debitor in debitors)
+
+    # Only the matches are kept to skip duplicates, not the debitors
+    seen = set()
+    for match in matches:
+        if match not in seen:
+            seen.add(match)
+            yield match
+
+
+def normalize_debitor(debitor: OpusDebitor) -> Person:
+    """Derive the keys a debitor is matched on.
+
+    Args:
+        debitor: The debitor from OPUS.
+
+    Returns:
+        The debitor as a Person.
+    """
+    first_name = debitor.first_name.split()[0] if debitor.first_name else ""
+    return Person(
+        record=debitor,
+        person_id=debitor.debitor_id,
+        first_name=first_name,
+        street=debitor.street,
+        zipcode=debitor.zipcode,
+        birthdate=common.get_birthdate(debitor.debitor_id)
+    )
+
+
+def write_excel(path: str, cases: Iterable[Match], report_date: date) -> int:
     """Write the given cases to an excel file on the given path.
+    Each case is written to the sheet of its category as it is read.
+    Only matches that haven't been sent on an earlier report are included unless
+    INCLUDE_PREVIOUSLY_REPORTED is set in config. The new matches are added to the ledger as pending.
 
     Args:
         path: Where to save the excel file.
-        cases: A tuple of cases in the format:
-            ((Debitor), (Case)) = ((fp, id, fornavn, efternavn, gade, husnr, postnummer, by), (X, Type, Sagsnummer, dato))
+        cases: The matches between OPUS debitors and Statstidende cases.
+        report_date: The date of the report.
+
+    Returns:
+        The number of new matches written to the file. Previously reported matches aren't counted.
     """
-    wb = openpyxl.Workbook()
-
-    # Create sheets
-    doedsboer_sheet = wb.active
-    doedsboer_sheet.title = "Dødsboer"
-    gaeldssaneringer_sheet = wb.create_sheet("Gældssaneringer")
-    konkursboer_sheet = wb.create_sheet("Konkursboer")
-    tvangsauktioner_sheet = wb.create_sheet("Tvangsauktioner")
-
-    # Add column names to sheets
-    doedsboer_sheet.append(("CPR", "Navn", "Adresse", "CPR på Sag", "Type", "Sagsnummer", "Sagsdato"))
-    gaeldssaneringer_sheet.append(("CPR", "Navn", "Adresse", "Navn på sag", "Type", "Sagsnummer", "Sagsdato"))
-    konkursboer_sheet.append(("CVR", "Navn", "Adresse", "CVR på sag", "Type", "Sagsnummer", "Sagsdato"))
-    tvangsauktioner_sheet.append(("ID", "Navn", "Adresse", "Adresse på sag", "Type", "Sagsnummer", "Sagsdato"))
-
-    for case in cases:
-        case_type = case[1][1]
-
-        debitor_id = case[0][1]
-        name = " ".join(filter(None, case[0][2:4]))
-        address = " ".join(filter(None, case[0][4:8]))
-        data = [debitor_id, name, address] + case[1]
-
-        if case_type.startswith("Dødsboer"):
-            doedsboer_sheet.append(data)
-        elif case_type.startswith("Gældssanering"):
-            gaeldssaneringer_sheet.append(data)
-        elif case_type.startswith("Konkursboer"):
-            konkursboer_sheet.append(data)
-        elif case_type.startswith("Tvangsauktioner"):
-            tvangsauktioner_sheet.append(data)
-
-    # Create excel tables for better formatting
-    for ws in wb:
-        dim = ws.dimensions
-        if dim == 'A1:G1':
-            continue
-        table = Table(displayName=ws.title, ref=dim)
-        table.tableStyleInfo = TableStyleInfo(name="TableStyleMedium9", showFirstColumn=False, showLastColumn=False, showRowStripes=True, showColumnStripes=True)
-        ws.add_table(table)
-
-    wb.save(path)
-    wb.close()
+    sheets = {
+        "Dødsboer": ("CPR", "Navn", "Adresse", "CPR på Sag", "Type", "Sagsnummer", "Sagsdato"),
+        "Gældssaneringer": ("CPR", "Navn", "Adresse", "Navn på sag", "Type", "Sagsnummer", "Sagsdato"),
+        "Konkursboer": ("CVR", "Navn", "Adresse", "CVR på sag", "Type", "Sagsnummer", "Sagsdato"),
+        "Tvangsauktioner": ("ID", "Navn", "Adresse", "Adresse på sag", "Type", "Sagsnummer", "Sagsdato")
+    }
+
+    if config.INCLUDE_PREVIOUSLY_REPORTED:
+        sheets[config.PREVIOUSLY_REPORTED_SHEET] = sent_matches.PREVIOUSLY_REPORTED_HEADER
+
+    # The ledger is saved before the workbook, so the new matches are never missing from it
+    with common.ExcelWriter(path, sheets) as writer:
+        with sent_matches.SentMatchLedger(config.SENT_MATCHES_DATABASE, SYSTEM_NAME, report_date) as ledger:
+            for debitor, case in cases:
+                # The case type is in the format "Category - Message type"
+                sheet_name = case.case_type.split(" - ", 1)[0]
+                if sheet_name in sheets:
+                    sheet_name = ledger.report(debitor.debitor_id, case.case_number, sheet_name)
+                    if sheet_name:
+                        writer.append(sheet_name, (debitor.debitor_id, debitor.name, debitor.address, *case))
+
+    return writer.count_rows(exclude=[config.PREVIOUSLY_REPORTED_SHEET])
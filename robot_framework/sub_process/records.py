@@ -0,0 +1,71 @@
+"""This module contains the records passed between the parts of the process.
+The records are named tuples, so they have no per instance dict and
+are written to json and Excel as plain rows.
+"""
+
+from typing import NamedTuple
+
+
+class StatstidendeCase(NamedTuple):
+    """A case from Statstidende.
+    The identifier is what the case is matched on: cpr, cvr, name or address depending on the category.
+    """
+    identifier: str
+    case_type: str
+    case_number: str
+    case_date: str
+
+
+class OpusDebitor(NamedTuple):
+    """A debitor from an OPUS debitor sheet."""
+    fp: str
+    debitor_id: str
+    first_name: str
+    last_name: str
+    street: str
+    street_no: str
+    zipcode: str
+    city: str
+
+    @property
+    def name(self) -> str:
+        """The full name of the debitor."""
+        return " ".join(filter(None, (self.first_name, self.last_name)))
+
+    @property
+    def address(self) -> str:
+        """The full address of the debitor."""
+        return " ".join(filter(None, (self.street, self.street_no, self.zipcode, self.city)))
+
+
+class BoliglaanLender(NamedTuple):
+    """A lender from a KMD Boliglån export."""
+    cpr: str
+    name: str
+    address: str
+
+
+class Address(NamedTuple):
+    """The parts of an address. Parts that aren't in the address are empty strings."""
+    street: str
+    house_number: str
+    zipcode: str
+    city: str
+
+
+class Person(NamedTuple):
+    """The keys a debitor or lender is matched on, derived once per record.
+    The id is a cpr or cvr number.
+    """
+    record: OpusDebitor | BoliglaanLender
+    person_id: str
+    first_name: str
+    street: str
+    zipcode: str
+    birthdate: str | None
+
+
+class Match(NamedTuple):
+    """A Statstidende case that could be relevant for a debitor or lender."""
+    person: OpusDebitor | BoliglaanLender
+    case: StatstidendeCase
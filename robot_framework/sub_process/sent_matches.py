@@ -0,0 +1,118 @@
+"""This module is responsible for the ledger of matches that have already been reported.
+The search window is a rolling number of days, so the same match is found on several
+runs in a row. The ledger is used to only report each match once.
+"""
+
+from contextlib import closing
+from datetime import date, timedelta
+import sqlite3
+
+from robot_framework import config
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sent_matches (
+    system TEXT NOT NULL,
+    person_id TEXT NOT NULL,
+    message_number TEXT NOT NULL,
+    report_date TEXT NOT NULL,
+    sent INTEGER NOT NULL,
+    PRIMARY KEY (system, person_id, message_number)
+);
+"""
+
+PREVIOUSLY_REPORTED_HEADER = ("ID", "Navn", "Adresse", "Sag", "Type", "Sagsnummer", "Sagsdato")
+
+
+class SentMatchLedger:
+    """The matches reported to a system keyed by person id and message number.
+    Matches are added as pending while the result workbook is written and saved
+    to the ledger when the context exits without errors.
+    They are marked as sent with mark_sent when the email has been sent.
+    """
+
+    def __init__(self, path: str, system: str, report_date: date):
+        """Open the ledger and load the matches already sent to the system.
+
+        Args:
+            path: The path of the ledger database.
+            system: The name of the system the matches are reported to.
+            report_date: The date of the report the new matches are added to.
+        """
+        self.path = path
+        self.system = system
+        self.report_date = report_date.isoformat()
+        self.pending = []
+
+        with closing(_connect(path)) as connection:
+            rows = connection.execute("SELECT person_id, message_number FROM sent_matches WHERE system = ? AND sent = 1", (system,))
+            self.sent = set(rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.save()
+
+    def is_sent(self, person_id: str, message_number: str) -> bool:
+        """Check if a match has been sent on an earlier report."""
+        return (person_id, message_number) in self.sent
+
+    def add(self, person_id: str, message_number: str) -> None:
+        """Add a match to the report as pending."""
+        self.pending.append((self.system, person_id, message_number, self.report_date))
+
+    def report(self, person_id: str, message_number: str, sheet_name: str) -> str | None:
+        """Find the sheet to report a match on and add the match as pending if it's new.
+        Matches sent on an earlier report are left out unless INCLUDE_PREVIOUSLY_REPORTED is set in config.
+
+        Args:
+            person_id: The cpr or cvr number of the debitor or lender.
+            message_number: The message number of the Statstidende case.
+            sheet_name: The sheet of the category of the case.
+
+        Returns:
+            The name of the sheet or None if the match is left out.
+        """
+        if self.is_sent(person_id, message_number):
+            return config.PREVIOUSLY_REPORTED_SHEET if config.INCLUDE_PREVIOUSLY_REPORTED else None
+
+        self.add(person_id, message_number)
+        return sheet_name
+
+    def save(self) -> None:
+        """Save the pending matches to the ledger in a single transaction.
+        Matches still pending from an earlier report are moved to this report.
+        """
+        with closing(_connect(self.path)) as connection:
+            with connection:
+                connection.executemany(
+                    """INSERT INTO sent_matches VALUES (?, ?, ?, ?, 0)
+                    ON CONFLICT DO UPDATE SET report_date = excluded.report_date WHERE sent = 0""",
+                    self.pending
+                )
+
+
+def mark_sent(path: str, system: str, report_date: date) -> None:
+    """Mark the matches of a report as sent and delete sent matches older than the retention period in config.
+
+    Args:
+        path: The path of the ledger database.
+        system: The name of the system the matches were reported to.
+        report_date: The date of the report.
+    """
+    oldest = (report_date - timedelta(days=config.SENT_MATCHES_RETENTION_DAYS)).isoformat()
+
+    with closing(_connect(path)) as connection:
+        with connection:
+            connection.execute("UPDATE sent_matches SET sent = 1 WHERE system = ? AND report_date = ?", (system, report_date.isoformat()))
+            connection.execute("DELETE FROM sent_matches WHERE report_date < ?", (oldest,))
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    """Connect to the ledger and create the table if needed.
+    The OPUS and KMD Boliglån branches can write at the same time, so writers wait for each other.
+    """
+    connection = sqlite3.connect(path, timeout=30)
+    connection.executescript(SCHEMA)
+    return connection
@@ -0,0 +1,108 @@
+"""This module is responsible for caching raw responses from the Statstidende API on disk.
+Published days never change, so a cached day can be reused on later runs.
+"""
+
+from datetime import date, timedelta
+import hashlib
+import json
+import os
+from typing import Any, Iterator
+
+from robot_framework import config
+
+
+def get_cache_key(message_types: list[str]) -> str:
+    """Create a short key identifying a set of message types.
+
+    Args:
+        message_types: The message type keys requested from the API.
+
+    Returns:
+        A hex digest which is the same for the same set of message types.
+    """
+    return hashlib.sha1("&".join(sorted(message_types)).encode()).hexdigest()[:12]
+
+
+def get_cache_path(publication_date: str, cache_key: str) -> str:
+    """Get the path of the cache file for the given date and cache key."""
+    return os.path.join(config.STATSTIDENDE_CACHE_DIR, f"{publication_date} {cache_key}.jsonl")
+
+
+def contains(publication_date: str, cache_key: str) -> bool:
+    """Check if a day is cached. Only days that were fetched in full are cached."""
+    return os.path.isfile(get_cache_path(publication_date, cache_key))
+
+
+def read(publication_date: str, cache_key: str) -> Iterator[dict[str, Any]] | None:
+    """Read a cached day of messages.
+
+    Args:
+        publication_date: The publication date in yyyy-mm-dd format.
+        cache_key: The key of the requested message types.
+
+    Returns:
+        An iterator over the cached messages or None if the day isn't cached.
+    """
+    if not contains(publication_date, cache_key):
+        return None
+
+    return _read_lines(get_cache_path(publication_date, cache_key))
+
+
+def _read_lines(path: str) -> Iterator[dict[str, Any]]:
+    """Read a cache file one message at a time."""
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            yield json.loads(line)
+
+
+class CacheWriter:
+    """Write the messages of a day to the cache one at a time.
+    The messages are written to a temporary file which is only moved into the cache
+    when the context exits without errors and the writer hasn't been discarded.
+    That way an interrupted download never leaves a partial day in the cache.
+    """
+
+    def __init__(self, publication_date: str, cache_key: str):
+        self.path = get_cache_path(publication_date, cache_key)
+        self.temp_path = self.path + ".tmp"
+        self.file = None
+        self.discarded = False
+
+    def __enter__(self):
+        os.makedirs(config.STATSTIDENDE_CACHE_DIR, exist_ok=True)
+        self.file = open(self.temp_path, 'w', encoding='utf-8')  # pylint: disable=consider-using-with
+        return self
+
+    def __exit__(self, exc_type, *_):
+        self.file.close()
+        if exc_type is None and not self.discarded:
+            os.replace(self.temp_path, self.path)
+        else:
+            os.remove(self.temp_path)
+
+    def add(self, message: dict[str, Any]) -> None:
+        """Add a message to the cache file."""
+        self.file.write(json.dumps(message, ensure_ascii=False))
+        self.file.write("\n")
+
+    def discard(self) -> None:
+        """Don't save the day to the cache when the context exits."""
+        self.discarded = True
+
+
+def evict(today: date) -> None:
+    """Delete cached days older than the retention period in config.
+
+    Args:
+        today: The date to count the retention period from.
+    """
+    if not os.path.isdir(config.STATSTIDENDE_CACHE_DIR):
+        return
+
+    oldest = (today - timedelta(days=config.STATSTIDENDE_CACHE_RETENTION_DAYS)).strftime("%Y-%m-%d")
+
+    for file_name in os.listdir(config.STATSTIDENDE_CACHE_DIR):
+        # File names start with the publication date which sorts as a string
+        if file_name[:10] < oldest:
+            os.remove(os.path.join(config.STATSTIDENDE_CACHE_DIR, file_name))
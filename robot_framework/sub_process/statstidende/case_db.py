@@ -0,0 +1,159 @@
+"""This module is responsible for the local database of parsed Statstidende cases.
+The search window is a rolling number of days, so most days of a run have already
+been parsed on an earlier run. Those days are read from the database instead.
+
+The database sits between the raw response cache and the daily case store:
+- The raw cache keeps the responses, so the database can be rebuilt without the
+  rate limited API when the parsing or the schema changes.
+- The database keeps the parsed cases per day, so only new days are parsed.
+- The case store is the checkpoint of the Statstidende stage for retries on the same day.
+"""
+
+from datetime import date, timedelta
+import json
+import sqlite3
+from typing import Iterable
+
+from robot_framework import config
+from robot_framework.sub_process.records import Address, StatstidendeCase
+
+# Bump when the schema changes. The tables are then rebuilt from the raw response cache.
+SCHEMA_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS days (
+    publication_date TEXT PRIMARY KEY,
+    cache_key TEXT NOT NULL,
+    complete INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cases (
+    message_number TEXT PRIMARY KEY,
+    publication_date TEXT NOT NULL,
+    category TEXT NOT NULL,
+    case_key TEXT NOT NULL,
+    identifier TEXT,
+    case_type TEXT,
+    case_date TEXT
+);
+CREATE INDEX IF NOT EXISTS cases_publication_date ON cases (publication_date);
+"""
+
+
+class CaseDatabase:
+    """A SQLite database of Statstidende cases keyed by message number.
+    Each case is stored with its publication date and category. The cases are
+    matched in memory, so they are only looked up by publication date.
+    Use the database as a context manager to close the connection afterwards.
+    """
+
+    def __init__(self, path: str, categories: tuple[str]):
+        """Open the database and create the tables if needed.
+        Tables from an older schema version are dropped first.
+
+        Args:
+            path: The path of the database file.
+            categories: The names of the categories in the order the case dicts are given and returned.
+        """
+        self.categories = categories
+        self.connection = sqlite3.connect(path)
+
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.connection.executescript(f"""
+                DROP TABLE IF EXISTS days;
+                DROP TABLE IF EXISTS cases;
+                PRAGMA user_version = {SCHEMA_VERSION};
+            """)
+
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.connection.close()
+
+    def has_day(self, publication_date: str, cache_key: str) -> bool:
+        """Check if all cases of a day are in the database.
+
+        Args:
+            publication_date: The publication date in yyyy-mm-dd format.
+            cache_key: The key of the message types the day was fetched with.
+
+        Returns:
+            True if the day was stored in full with the same message types.
+        """
+        row = self.connection.execute("SELECT cache_key, complete FROM days WHERE publication_date = ?", (publication_date,)).fetchone()
+        return row is not None and row[0] == cache_key and row[1] == 1
+
+    def add_day(self, publication_date: str, cache_key: str, day_cases: tuple[dict], complete: bool) -> None:
+        """Replace the cases of a day with the given cases.
+
+        Args:
+            publication_date: The publication date in yyyy-mm-dd format.
+            cache_key: The key of the message types the day was fetched with.
+            day_cases: The case dicts of the day in the order of the categories.
+            complete: Whether no more cases can be published on the day.
+        """
+        rows = []
+        for category, cases in zip(self.categories, day_cases):
+            for case_key, value in cases.items():
+                # Gældssaneringer are stored as a list of cases per birthdate
+                for case in value if isinstance(value, list) else (value,):
+                    rows.append((case.case_number, publication_date, category, _encode_key(case_key), case.identifier, case.case_type, case.case_date))
+
+        with self.connection:
+            self.connection.execute("DELETE FROM cases WHERE publication_date = ?", (publication_date,))
+            self.connection.executemany("INSERT OR REPLACE INTO cases VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT OR REPLACE INTO days VALUES (?, ?, ?)", (publication_date, cache_key, int(complete)))
+
+    def load_cases(self, publication_dates: Iterable[str]) -> tuple[dict]:
+        """Load the cases of the given days.
+        The days are combined newest first in the same way as when they're fetched.
+
+        Args:
+            publication_dates: The publication dates in yyyy-mm-dd format.
+
+        Returns:
+            A dict per category in the order of the categories.
+        """
+        publication_dates = list(publication_dates)
+        result = tuple({} for _ in self.categories)
+        category_cases = dict(zip(self.categories, result))
+
+        rows = self.connection.execute(
+            f"""SELECT category, case_key, identifier, case_type, message_number, case_date FROM cases
+            WHERE publication_date IN ({", ".join("?" * len(publication_dates))})
+            ORDER BY publication_date DESC, rowid""",
+            publication_dates
+        )
+
+        for category, case_key, *case in rows:
+            cases = category_cases[category]
+            case_key = _decode_key(category, case_key)
+            if category == "gaeldssaneringer":
+                cases.setdefault(case_key, []).append(StatstidendeCase(*case))
+            else:
+                cases[case_key] = StatstidendeCase(*case)
+
+        return result
+
+    def evict(self, today: date) -> None:
+        """Delete days older than the retention period in config.
+
+        Args:
+            today: The date to count the retention period from.
+        """
+        oldest = (today - timedelta(days=config.STATSTIDENDE_CACHE_RETENTION_DAYS)).strftime("%Y-%m-%d")
+        with self.connection:
+            self.connection.execute("DELETE FROM cases WHERE publication_date < ?", (oldest,))
+            self.connection.execute("DELETE FROM days WHERE publication_date < ?", (oldest,))
+
+
+def _encode_key(case_key: str | Address) -> str:
+    """Encode the key of a case as text. Tvangsauktioner are keyed by the parts of the address."""
+    return json.dumps(case_key, ensure_ascii=False) if isinstance(case_key, Address) else case_key
+
+
+def _decode_key(category: str, case_key: str) -> str | Address:
+    """Decode the key of a case encoded by _encode_key."""
+    return Address(*json.loads(case_key)) if category == "tvangsauktioner" else case_key
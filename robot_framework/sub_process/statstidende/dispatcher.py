@@ -0,0 +1,92 @@
+"""This module routes Statstidende messages to the handler of their category."""
+
+from typing import Any, Callable, Iterable
+
+Field = tuple[str, str]
+Handler = Callable[[dict, dict[str, Any], dict[Field, str]], None]
+
+
+class MessageDispatcher:
+    """A registry of message handlers keyed by messageTypePublicKey.
+    Each handler adds the case in a message to the dict of its category.
+    The categories are returned in the order they were first registered.
+
+    Each handler declares the (field group, field) pairs it needs. These are indexed
+    once per message and passed to the handler, so extractors don't scan the field groups themselves.
+    """
+
+    def __init__(self):
+        self.handlers: dict[str, tuple[str, Handler, frozenset[Field], frozenset[str]]] = {}
+        self.categories: list[str] = []
+
+    def register(self, category: str, message_types: Iterable[str], handler: Handler, fields: Iterable[Field]) -> None:
+        """Register a handler for the given message types.
+
+        Args:
+            category: The name of the category the handler adds cases to.
+            message_types: The messageTypePublicKeys to route to the handler.
+            handler: A function taking the dict of cases in the category, a message and its field index.
+            fields: The (field group, field) pairs the handler reads from the message.
+
+        Raises:
+            ValueError: If a message type already has a handler.
+        """
+        if category not in self.categories:
+            self.categories.append(category)
+
+        fields = frozenset(fields)
+        groups = frozenset(group for group, _ in fields)
+
+        for message_type in message_types:
+            if message_type in self.handlers:
+                raise ValueError(f"Message type {message_type} is already registered to {self.handlers[message_type][0]}.")
+            self.handlers[message_type] = (category, handler, fields, groups)
+
+    def message_types(self) -> list[str]:
+        """Get all registered message types."""
+        return list(self.handlers)
+
+    def parse_messages(self, messages: Iterable[dict[str, Any]]) -> tuple[dict]:
+        """Sort the given messages into their categories of cases in a single pass.
+        Messages of unregistered types are skipped.
+
+        Args:
+            messages: The Statstidende messages to parse.
+
+        Returns:
+            A dict of cases per category in the order the categories were registered.
+        """
+        cases = {category: {} for category in self.categories}
+
+        for message in messages:
+            entry = self.handlers.get(message["messageTypePublicKey"])
+            if entry:
+                category, handler, fields, groups = entry
+                handler(cases[category], message, index_fields(message, fields, groups))
+
+        return tuple(cases.values())
+
+
+def index_fields(message: dict[str, Any], fields: frozenset[Field], groups: frozenset[str]) -> dict[Field, str]:
+    """Index the values of the given fields in a message in a single pass.
+    Field groups that aren't needed are skipped entirely.
+    If a field occurs more than once the first value is used.
+
+    Args:
+        message: The Statstidende message.
+        fields: The (field group, field) pairs to index.
+        groups: The names of the field groups in fields.
+
+    Returns:
+        A dict in the format: (field group, field) -> value
+    """
+    index = {}
+    for field_group in message['fieldGroups']:
+        group_name = field_group['name']
+        if group_name in groups:
+            for field in field_group['fields']:
+                key = (group_name, field['name'])
+                if key in fields and key not in index:
+                    index[key] = field['value']
+
+    return index
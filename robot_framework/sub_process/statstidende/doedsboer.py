@@ -2,6 +2,8 @@
 
 from typing import Any
 
+from robot_framework.sub_process.records import StatstidendeCase
+
 
 DOEDSBOER_KEYS = {
     "431a79af-df1f-5c4b-a7a4-a20aadda8c0a": "Proklama",
@@ -11,34 +13,31 @@ DOEDSBOER_KEYS = {
     "8782d80c-3afd-5d48-9f9f-272e3c869911": "Proklama (Færøerne og Grønland)"
 }
 
+CPR_FIELD = ('Afdøde', 'CPR-nr.')
+
+FIELDS = (CPR_FIELD,)
+
 
-def get_doedsboer(data: dict[str: Any]) -> dict[str, tuple[str]]:
-    """Get all dødsboer from the given data.
+def add_case(doedsboer: dict[str, StatstidendeCase], message: dict[str, Any], fields: dict[tuple[str, str], str]) -> None:
+    """Add the dødsbo in the given message to the dict of dødsboer.
+    Dødsboer without a cpr number are skipped.
 
-    Returns:
-        A dict in the format: cpr -> (cpr, Type, Case number, Case date)
+    Args:
+        doedsboer: A dict in the format: cpr -> (cpr, Type, Case number, Case date)
+        message: A Statstidende message of one of the types in DOEDSBOER_KEYS.
+        fields: The indexed FIELDS of the message.
     """
-    doedsboer = {}
-    for message in data:
-        if message["messageTypePublicKey"] in DOEDSBOER_KEYS:
-            cpr = get_cpr(message)
-            case_type = "Dødsboer - " + get_case_type(message)
-            case_number = get_case_number(message)
-            case_date = get_case_date(message)
-            doedsboer[cpr] = (cpr, case_type, case_number, case_date)
-
-    return doedsboer
-
-
-def get_cpr(message: dict[str, Any]) -> str:
-    """Extract the cpr number from a Statstidende message."""
-    for fg in message['fieldGroups']:
-        if fg['name'] == 'Afdøde':
-            for f in fg['fields']:
-                if f['name'] == 'CPR-nr.':
-                    return f['value']
-
-    return None
+    cpr = get_cpr(fields)
+    case_type = "Dødsboer - " + get_case_type(message)
+    case_number = get_case_number(message)
+    case_date = get_case_date(message)
+    if cpr:
+        doedsboer[cpr] = StatstidendeCase(cpr, case_type, case_number, case_date)
+
+
+def get_cpr(fields: dict[tuple[str, str], str]) -> str:
+    """Extract the cpr number from the indexed fields of a Statstidende message."""
+    return fields.get(CPR_FIELD)
 
 
 def get_case_type(message: dict[str, Any]) -> str:
@@ -2,6 +2,8 @@
 
 from typing import Any
 
+from robot_framework.sub_process.records import StatstidendeCase
+
 
 GAELDSSANERINGER_KEYS = {
     "96d0fb63-1a78-5e5c-ac54-6fb04f9cca41": "Indledning - præklusivt proklama",
@@ -11,51 +13,45 @@ GAELDSSANERINGER_KEYS = {
     "addc8185-5bc7-52b6-a7c4-fd12654e8351": "Andre meddelelser"
 }
 
+BIRTHDATE_FIELD = ('Skyldner(e)', 'Fødselsdato')
+NAME_FIELD = ('Skyldner(e)', 'Navn')
 
-def get_gaeldssaneringer(data: dict[str, Any]) -> dict[str, list[tuple[str]]]:
-    """Get all gældssaneringer from the given data.
-
-    Returns:
-        A dict in the format: birthdate -> list[ (Name, Type, Case number, Case date) ]
-    """
-    gaeldssaneringer = {}
+FIELDS = (BIRTHDATE_FIELD, NAME_FIELD)
 
-    for message in data:
-        if message["messageTypePublicKey"] in GAELDSSANERINGER_KEYS:
-            birthdate = get_birthdate(message)
-            name = get_name(message)
-            case_type = "Gældssaneringer - " + get_case_type(message)
-            case_number = get_case_number(message)
-            case_date = get_case_date(message)
 
-            if birthdate not in gaeldssaneringer:
-                gaeldssaneringer[birthdate] = []
+def add_case(gaeldssaneringer: dict[str, list[StatstidendeCase]], message: dict[str, Any], fields: dict[tuple[str, str], str]) -> None:
+    """Add the gældssanering in the given message to the dict of gældssaneringer.
+    There might be multiple gældssaneringer per birthdate so they are kept in lists.
+    Gældssaneringer without a birthdate are skipped.
 
-            gaeldssaneringer[birthdate].append((name, case_type, case_number, case_date))
+    Args:
+        gaeldssaneringer: A dict in the format: birthdate -> list[ (Name, Type, Case number, Case date) ]
+        message: A Statstidende message of one of the types in GAELDSSANERINGER_KEYS.
+        fields: The indexed FIELDS of the message.
+    """
+    birthdate = get_birthdate(fields)
+    name = get_name(fields)
+    case_type = "Gældssaneringer - " + get_case_type(message)
+    case_number = get_case_number(message)
+    case_date = get_case_date(message)
 
-    return gaeldssaneringer
+    if not birthdate:
+        return
 
+    if birthdate not in gaeldssaneringer:
+        gaeldssaneringer[birthdate] = []
 
-def get_birthdate(message: dict[str, Any]) -> str:
-    """Extract the birthdate from a Statstidende message."""
-    for field_group in message['fieldGroups']:
-        if field_group['name'] == 'Skyldner(e)':
-            for field in field_group['fields']:
-                if field['name'] == 'Fødselsdato':
-                    return field['value']
+    gaeldssaneringer[birthdate].append(StatstidendeCase(name, case_type, case_number, case_date))
 
-    return None
 
+def get_birthdate(fields: dict[tuple[str, str], str]) -> str:
+    """Extract the birthdate from the indexed fields of a Statstidende message."""
+    return fields.get(BIRTHDATE_FIELD)
 
-def get_name(message: dict[str, Any]) -> str:
-    """Extract the name from a Statstidende message."""
-    for field_group in message['fieldGroups']:
-        if field_group['name'] == 'Skyldner(e)':
-            for field in field_group['fields']:
-                if field['name'] == 'Navn':
-                    return field['value']
 
-    return None
+def get_name(fields: dict[tuple[str, str], str]) -> str:
+    """Extract the name from the indexed fields of a Statstidende message."""
+    return fields.get(NAME_FIELD)
 
 
 def get_case_type(message: dict[str, Any]) -> str:
@@ -2,6 +2,8 @@
 
 from typing import Any
 
+from robot_framework.sub_process.records import StatstidendeCase
+
 
 KONKURSBOER_KEYS = {
     "383f1800-1b39-5f39-8250-61a5c0798fad": "Ophævelse af dekret",
@@ -12,35 +14,31 @@ KONKURSBOER_KEYS = {
     "14a1d71d-f215-58e5-ade0-214f90482cdc": "Dekret"
 }
 
+CVR_FIELD = ('Skyldner(e)', 'CVR-nr.')
+
+FIELDS = (CVR_FIELD,)
+
 
-def get_konkursboer(data: dict[str: Any]) -> dict[str, tuple[str]]:
-    """Get all konkursboer from the given data.
+def add_case(konkursboer: dict[str, StatstidendeCase], message: dict[str, Any], fields: dict[tuple[str, str], str]) -> None:
+    """Add the konkursbo in the given message to the dict of konkursboer.
+    Konkursboer without a cvr number are skipped.
 
-    Returns:
-        A dict in the format: cvr -> (cvr, Type, Case number, Case date)
+    Args:
+        konkursboer: A dict in the format: cvr -> (cvr, Type, Case number, Case date)
+        message: A Statstidende message of one of the types in KONKURSBOER_KEYS.
+        fields: The indexed FIELDS of the message.
     """
-    konkursboer = {}
-    for message in data:
-        if message["messageTypePublicKey"] in KONKURSBOER_KEYS:
-            cvr = get_cvr(message)
-            case_type = "Konkursboer - " + get_case_type(message)
-            case_number = get_case_number(message)
-            case_date = get_case_date(message)
-            if cvr:
-                konkursboer[cvr] = (cvr, case_type, case_number, case_date)
-
-    return konkursboer
-
-
-def get_cvr(message: dict[str, Any]) -> str:
-    """Extract the cvr number from a Statstidende message."""
-    for field_group in message['fieldGroups']:
-        if field_group['name'] == 'Skyldner(e)':
-            for field in field_group['fields']:
-                if field['name'] == 'CVR-nr.':
-                    return field['value']
-
-    return None
+    cvr = get_cvr(fields)
+    case_type = "Konkursboer - " + get_case_type(message)
+    case_number = get_case_number(message)
+    case_date = get_case_date(message)
+    if cvr:
+        konkursboer[cvr] = StatstidendeCase(cvr, case_type, case_number, case_date)
+
+
+def get_cvr(fields: dict[tuple[str, str], str]) -> str:
+    """Extract the cvr number from the indexed fields of a Statstidende message."""
+    return fields.get(CVR_FIELD)
 
 
 def get_case_type(message: dict[str, Any]) -> str:
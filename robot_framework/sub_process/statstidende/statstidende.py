@@ -1,15 +1,33 @@
 """This module is responsible for collecting data from the Statstidende API."""
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import json
+import os
+import pickle
+import tempfile
+import threading
 import time
+from typing import Any, Iterable, Iterator
 
 import requests
+from requests.adapters import HTTPAdapter
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
 from hvac import Client
 
 from robot_framework import config
-from robot_framework.sub_process.statstidende import doedsboer, gaeldssaneringer, konkursboer, tvangsauktioner
+from robot_framework.sub_process.statstidende import cache, case_db, doedsboer, gaeldssaneringer, konkursboer, tvangsauktioner
+from robot_framework.sub_process.statstidende.dispatcher import MessageDispatcher
+
+# The API returns a client error for sundays and mondays (see datetime.weekday)
+UNSEARCHABLE_WEEKDAYS = (6, 0)
+
+# The categories are registered in the order they are returned from load_statstidende_cases.
+DISPATCHER = MessageDispatcher()
+DISPATCHER.register("doedsboer", doedsboer.DOEDSBOER_KEYS, doedsboer.add_case, doedsboer.FIELDS)
+DISPATCHER.register("gaeldssaneringer", gaeldssaneringer.GAELDSSANERINGER_KEYS, gaeldssaneringer.add_case, gaeldssaneringer.FIELDS)
+DISPATCHER.register("konkursboer", konkursboer.KONKURSBOER_KEYS, konkursboer.add_case, konkursboer.FIELDS)
+DISPATCHER.register("tvangsauktioner", tvangsauktioner.TVANGSAUKTIONER_KEYS, tvangsauktioner.add_case, tvangsauktioner.FIELDS)
 
 
 def load_statstidende_cases(days: int, orchestrator_connection: OrchestratorConnection) -> tuple[dict]:
@@ -23,31 +41,29 @@ def load_statstidende_cases(days: int, orchestrator_connection: OrchestratorConn
     Returns:
         Four dictionaries with (dødsboer, gældssaneringer, konkursboer, tvangsauktioner)
     """
-    doedsboer_cases = {}
-    tvangsauktioner_cases = {}
-    gaeldssaneringer_cases = {}
-    konkursboer_cases = {}
-
     today = datetime.now().date()
+    cache.evict(today)
+    dates = [(today + timedelta(days=-i)).strftime("%Y-%m-%d") for i in range(days)]
+    cache_key = cache.get_cache_key(DISPATCHER.message_types())
+
+    with case_db.CaseDatabase(config.STATSTIDENDE_CASE_DATABASE, tuple(DISPATCHER.categories)) as database:
+        database.evict(today)
 
-    for i in range(days):
-        date = today + timedelta(days=-i)
-        data = get_api_data(date.strftime("%Y-%m-%d"), orchestrator_connection)
-
-        if data:
-            # Combine case data with data from other days
-            doedsboer_cases |= doedsboer.get_doedsboer(data)
-            tvangsauktioner_cases |= tvangsauktioner.get_tvangsauktioner(data)
-            konkursboer_cases |= konkursboer.get_konkursboer(data)
-
-            # There might be multiple gældssaneringer per debitor_id.
-            # Combine the results as lists
-            temp_gaeldssaneringer = gaeldssaneringer.get_gaeldssaneringer(data)
-            for foedselsdato, case_list in temp_gaeldssaneringer.items():
-                if foedselsdato in gaeldssaneringer_cases:
-                    gaeldssaneringer_cases[foedselsdato] += case_list
-                else:
-                    gaeldssaneringer_cases[foedselsdato] = case_list
+        # Days parsed on an earlier run are read from the database. Today is always fetched
+        # since new messages might still be published.
+        new_dates = [date for date in dates if not database.has_day(date, cache_key)]
+
+        # Fetch and parse the new days concurrently and store them as they finish.
+        # The requests themselves are spaced out by the client's rate limiter.
+        # A day is complete when it was cached, i.e. it's in the past and was fetched without errors.
+        with StatstidendeClient(orchestrator_connection) as client, ThreadPoolExecutor(max_workers=config.STATSTIDENDE_MAX_WORKERS) as executor:
+            day_cases = executor.map(lambda date: DISPATCHER.parse_messages(client.iter_messages(date)), new_dates)
+            for date, cases in zip(new_dates, day_cases):
+                database.add_day(date, cache_key, cases, complete=cache.contains(date, cache_key))
+
+        # The days are combined newest first. Gældssaneringer are combined as lists
+        # since there might be multiple gældssaneringer per birthdate.
+        doedsboer_cases, gaeldssaneringer_cases, konkursboer_cases, tvangsauktioner_cases = database.load_cases(dates)
 
     if len(doedsboer_cases) == 0 or len(doedsboer_cases) == 0 or len(gaeldssaneringer_cases) == 0 or len(konkursboer_cases) == 0 or len(tvangsauktioner_cases) == 0:
         raise RuntimeError(f"Got an unexpected number of cases from Statstidende: Dødsboer: {len(doedsboer_cases)}. Gældssaneringer: {len(gaeldssaneringer_cases)}. Konkursboer: {len(konkursboer_cases)}. Tvangsauktioner: {len(tvangsauktioner_cases)}.")
@@ -57,58 +73,261 @@ def load_statstidende_cases(days: int, orchestrator_connection: OrchestratorConn
     return (doedsboer_cases, gaeldssaneringer_cases, konkursboer_cases, tvangsauktioner_cases)
 
 
-def get_api_data(date: str, orchestrator_connection: OrchestratorConnection) -> dict | None:
-    """Get the data from Statstidende on the given date.
+class StatstidendeClient:
+    """A client for the Statstidende API.
+    The certificate is fetched from the key vault once and all requests
+    share a single pool of keep-alive connections and a rate limiter.
+    Use the client as a context manager to clean up the certificate file afterwards.
+    """
+
+    def __init__(self, orchestrator_connection: OrchestratorConnection):
+        self.orchestrator_connection = orchestrator_connection
+
+        # Join all the relevant message types
+        message_types = DISPATCHER.message_types()
+        self.message_types = "".join(f"&messagetypes={t}" for t in message_types)
+        self.cache_key = cache.get_cache_key(message_types)
+
+        self.certificate_path = get_certification_file(orchestrator_connection)
+
+        self.session = requests.Session()
+        self.session.cert = self.certificate_path
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.STATSTIDENDE_MAX_WORKERS)
+        self.session.mount("https://", adapter)
+
+        self.rate_limiter = RateLimiter(config.STATSTIDENDE_MIN_REQUEST_INTERVAL)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self) -> None:
+        """Close the connection pool and delete the certificate file."""
+        self.session.close()
+        if os.path.isfile(self.certificate_path):
+            os.remove(self.certificate_path)
+
+    def iter_messages(self, date: str) -> Iterator[dict[str, Any]]:
+        """Get the messages from Statstidende on the given date one at a time.
+        The response is parsed incrementally and any following pages are fetched as well.
+        Past days are read from the cache if possible. Today is always fetched
+        since new messages might still be published.
+
+        Args:
+            date: The date to retrieve data from in yyyy-mm-dd format.
+
+        Yields:
+            The messages published on the date if any.
+
+        Raises:
+            RuntimeError: If the API returns an error for a following page.
+        """
+        if date < datetime.now().strftime("%Y-%m-%d"):
+            messages = cache.read(date, self.cache_key)
+            if messages is not None:
+                self.orchestrator_connection.log_info(f"Using cached Statstidende data from: {date}")
+                yield from messages
+                return
+
+        url = f"{config.STATSTIDENDE_API_URL}?publicationdate={date}{self.message_types}"
+        self.orchestrator_connection.log_info(f"Fetching Statstidende data from: {date}")
+
+        with cache.CacheWriter(date, self.cache_key) as cache_writer:
+            # Today isn't complete yet, so it's never cached
+            if date >= datetime.now().strftime("%Y-%m-%d"):
+                cache_writer.discard()
+
+            first_page = True
+            while url:
+                with self._get(url) as response:
+                    status = response.status_code
+
+                    if status != 200:
+                        # Sundays and mondays can't be searched. The error won't change on a later run,
+                        # so the day is cached without messages.
+                        if first_page and is_unsearchable_day(date, status):
+                            return
+
+                        # Other errors aren't cached, so the day is fetched again on the next run
+                        cache_writer.discard()
+                        error = f"Got status code {status} from Statstidende on {date}: {response.text[:200]}"
+
+                        # Days without publication, like public holidays, might give an error as well.
+                        # Since that can't be told apart from other errors the day is treated as without messages.
+                        # Messages from earlier pages have already been returned, so an error after those is raised.
+                        if first_page:
+                            self.orchestrator_connection.log_error(f"{error}\nThe day is treated as a day without messages.")
+                            return
+
+                        raise RuntimeError(error)
+
+                    # The API returns json but doesn't always specify the encoding
+                    response.encoding = "utf-8"
+                    for message in iter_json_array(response.iter_content(chunk_size=65536, decode_unicode=True)):
+                        cache_writer.add(message)
+                        yield message
+
+                    # Follow the next page if the API pages the result
+                    url = response.links.get("next", {}).get("url")
+                    first_page = False
+
+    def _get(self, url: str) -> requests.Response:
+        """Send a streamed GET request when the rate limiter allows it
+        and retry while the API is throttling.
+
+        Args:
+            url: The url to request.
+
+        Returns:
+            The first response that isn't throttled.
+
+        Raises:
+            RuntimeError: If the API is still throttling after the number of tries in config.
+        """
+        for _ in range(config.STATSTIDENDE_MAX_TRIES):
+            self.rate_limiter.wait()
+            response = self.session.get(url, stream=True)
+            if response.status_code != 429:
+                return response
+
+            # Hold back all workers as long as the API asks
+            response.close()
+            retry_after = response.headers.get("Retry-After", "")
+            self.rate_limiter.delay(int(retry_after) if retry_after.isdigit() else config.STATSTIDENDE_MIN_REQUEST_INTERVAL)
+
+        raise RuntimeError(f"Statstidende is still throttling requests after {config.STATSTIDENDE_MAX_TRIES} tries.")
+
+
+class RateLimiter:
+    """Space out calls from any number of threads by a minimum interval."""
+
+    def __init__(self, interval: float):
+        """Create a rate limiter that lets the first call through at once.
+
+        Args:
+            interval: The minimum number of seconds between calls.
+        """
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self) -> None:
+        """Block until the interval since the last call has passed.
+        Waiting threads are let through one at a time.
+        """
+        with self.lock:
+            remaining = self.next_time - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            self.next_time = time.monotonic() + self.interval
+
+    def delay(self, seconds: float) -> None:
+        """Make the next call wait at least the given number of seconds from now."""
+        with self.lock:
+            self.next_time = max(self.next_time, time.monotonic() + seconds)
+
+
+def is_unsearchable_day(date: str, status: int) -> bool:
+    """Check if a response is the error the API returns for days that can't be searched.
 
     Args:
-        date: The date to retrieve data from in yyyy-mm-dd format.
-        orchestrator_connection: The connection to OpenOrchestrator.
+        date: The date that was searched in yyyy-mm-dd format.
+        status: The status code of the response.
 
     Returns:
-        The response json if any.
+        True if the date is a sunday or monday and the API returned a client error.
+    """
+    weekday = datetime.strptime(date, "%Y-%m-%d").weekday()
+    return weekday in UNSEARCHABLE_WEEKDAYS and 400 <= status < 500 and status != 429
+
+
+def iter_json_array(chunks: Iterable[str]) -> Iterator[Any]:
+    """Parse a json array from a stream of text chunks and yield
+    each element as soon as it has been read in full.
+
+    Args:
+        chunks: The text of a json array split into chunks of any size.
+
+    Yields:
+        The elements of the array.
+
+    Raises:
+        ValueError: If the text isn't a complete json array.
     """
-    # Join all the relevant message types
-    message_types = [f"&messagetypes={t}" for t in doedsboer.DOEDSBOER_KEYS]
-    message_types += [f"&messagetypes={t}" for t in gaeldssaneringer.GAELDSSANERINGER_KEYS]
-    message_types += [f"&messagetypes={t}" for t in konkursboer.KONKURSBOER_KEYS]
-    message_types += [f"&messagetypes={t}" for t in tvangsauktioner.TVANGSAUKTIONER_KEYS]
-    message_types = "".join(message_types)
+    decoder = json.JSONDecoder()
+    buffer = ""
+    array_started = False
+
+    for chunk in chunks:
+        buffer += chunk
+        position = 0
+
+        while True:
+            # Skip whitespace and separators between elements
+            while position < len(buffer) and (buffer[position].isspace() or (array_started and buffer[position] == ',')):
+                position += 1
 
-    url = f"https://api.statstidende.dk/v1/messages?publicationdate={date}{message_types}"
-    orchestrator_connection.log_info(f"Fetching Statstidende data from: {date}")
+            if position == len(buffer):
+                break
 
-    session = requests.Session()
-    session.cert = get_certification_file(orchestrator_connection)
+            if not array_started:
+                if buffer[position] != '[':
+                    raise ValueError("Expected a json array from Statstidende.")
+                array_started = True
+                position += 1
+                continue
 
-    for _ in range(10):
-        response = session.get(url)
-        status = response.status_code
+            if buffer[position] == ']':
+                return
 
-        if status == 200:
-            return response.json()
+            try:
+                element, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The element isn't complete yet. Wait for the next chunk.
+                break
 
-        if status == 429:
-            time.sleep(2)
-        else:
-            return None
+            yield element
 
-    return None
+        buffer = buffer[position:]
+
+    raise ValueError("The json array from Statstidende ended unexpectedly.")
 
 
 def create_cases_file(path: str, orchestrator_connection: OrchestratorConnection):
-    """Get data from Statstidende for the last 7 days and dump it in a text file.
+    """Get data from Statstidende for the last 7 days and save it in a case store.
+    The store only holds the case records, so a retry doesn't have to parse the cases again.
+    The matcher is built from them on each attempt with the current config.
 
     Args:
         path: The path to save the file on.
+        orchestrator_connection: The connection to Orchestrator.
     """
     cases = load_statstidende_cases(days=7, orchestrator_connection=orchestrator_connection)
 
-    with open(path, 'w', encoding='utf-8') as file:
-        json.dump(cases, file, indent=4, ensure_ascii=False)
+    # Write to a temporary file first so a failed write doesn't leave a broken store behind
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as file:
+        pickle.dump(cases, file, protocol=5)
+    os.replace(temp_path, path)
+
+
+def load_cases_file(path: str) -> tuple[dict]:
+    """Load the case store saved by create_cases_file.
+
+    Args:
+        path: The path of the case store.
+
+    Returns:
+        Four dictionaries with (dødsboer, gældssaneringer, konkursboer, tvangsauktioner)
+    """
+    with open(path, 'rb') as file:
+        return pickle.load(file)
 
 
 def get_certification_file(orchestrator_connection: OrchestratorConnection) -> str:
-    """Get the certificate from the key vault and write it to a file.
+    """Get the certificate from the key vault and write it to a temporary file.
 
     Args:
         orchestrator_connection: The connection to Orchestrator.
@@ -128,8 +347,8 @@ def get_certification_file(orchestrator_connection: OrchestratorConnection) -> s
     certificate = read_response['data']['data']['cert']
 
     # Write to file
-    certificate_path = "certificate.pem"
-    with open(certificate_path, 'w', encoding='utf-8') as cert_file:
+    file_descriptor, certificate_path = tempfile.mkstemp(suffix=".pem")
+    with open(file_descriptor, 'w', encoding='utf-8') as cert_file:
         cert_file.write(certificate)
 
     return certificate_path
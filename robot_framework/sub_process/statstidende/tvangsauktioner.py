@@ -2,6 +2,9 @@
 
 from typing import Any
 
+from robot_framework.sub_process import addresses
+from robot_framework.sub_process.records import Address, StatstidendeCase
+
 
 TVANGSAUKTIONER_KEYS = {
     "2aa7d6a1-b250-51a8-88a6-3f6c18574526": "Fast ejendom",
@@ -9,45 +12,39 @@ TVANGSAUKTIONER_KEYS = {
     # "2fb3c7d1-2198-5b88-b4ca-f27d4b95fc06": "Aflysninger, udsættelser og berigtigelser"
 }
 
+STREET_FIELD = ('Ejendom', 'Vejnavn')
+NUMBER_FIELD = ('Ejendom', 'Husnr.')
+ZIPCODE_FIELD = ('Ejendom', 'Postnr')
+CITY_FIELD = ('Ejendom', 'By')
+
+FIELDS = (STREET_FIELD, NUMBER_FIELD, ZIPCODE_FIELD, CITY_FIELD)
+
 
-def get_tvangsauktioner(data: dict[str: Any]) -> dict[str, tuple[str]]:
-    """Get all tvangsauktioner from the given data.
+def add_case(tvangsauktioner: dict[Address, StatstidendeCase], message: dict[str, Any], fields: dict[tuple[str, str], str]) -> None:
+    """Add the tvangsauktion in the given message to the dict of tvangsauktioner.
+    The case is keyed by the parts of the address as they are given in the message,
+    so the street is never split from a joined address.
 
-    Returns:
-        A dict in the format: address -> (address, Type, Case number, Case date)
+    Args:
+        tvangsauktioner: A dict in the format: address parts -> (address, Type, Case number, Case date)
+        message: A Statstidende message of one of the types in TVANGSAUKTIONER_KEYS.
+        fields: The indexed FIELDS of the message.
     """
-    tvangsauktioner = {}
-    for message in data:
-        if message["messageTypePublicKey"] in TVANGSAUKTIONER_KEYS:
-            address = get_address(message)
-            case_type = "Tvangsauktioner - " + get_case_type(message)
-            case_number = get_case_number(message)
-            case_date = get_case_date(message)
-            tvangsauktioner[address] = (address, case_type, case_number, case_date)
-
-    return tvangsauktioner
-
-
-def get_address(message: dict[str, Any]) -> str:
-    """Extract the address number from a Statstidende message."""
-    street = ""
-    number = ""
-    zipcode = ""
-    city = ""
-
-    for field_group in message['fieldGroups']:
-        if field_group['name'] == 'Ejendom':
-            for field in field_group['fields']:
-                if field['name'] == 'Vejnavn':
-                    street = field['value']
-                elif field['name'] == 'Husnr.':
-                    number = field['value']
-                elif field['name'] == 'Postnr':
-                    zipcode = field['value']
-                elif field['name'] == 'By':
-                    city = field['value']
-
-    return " ".join((street, number, zipcode, city))
+    address = get_address(fields)
+    case_type = "Tvangsauktioner - " + get_case_type(message)
+    case_number = get_case_number(message)
+    case_date = get_case_date(message)
+    tvangsauktioner[address] = StatstidendeCase(addresses.format_address(*address), case_type, case_number, case_date)
+
+
+def get_address(fields: dict[tuple[str, str], str]) -> Address:
+    """Extract the parts of the address from the indexed fields of a Statstidende message."""
+    return Address(
+        street=fields.get(STREET_FIELD) or "",
+        house_number=fields.get(NUMBER_FIELD) or "",
+        zipcode=fields.get(ZIPCODE_FIELD) or "",
+        city=fields.get(CITY_FIELD) or ""
+    )
 
 
 def get_case_type(message: dict[str, Any]) -> str:
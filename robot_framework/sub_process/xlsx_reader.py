@@ -0,0 +1,209 @@
+"""This module reads rows from xlsx files by parsing the sheet xml directly.
+It avoids openpyxl's cell objects, which dominate the load time of large sheets.
+Both transitional and strict OOXML files can be read.
+"""
+
+from datetime import datetime
+from io import BytesIO
+import posixpath
+from typing import Any, Callable, Iterator, NamedTuple, Sequence
+from xml.etree import ElementTree
+import zipfile
+
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format, is_timedelta_format
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel, from_ISO8601
+
+
+class Styles(NamedTuple):
+    """The cell styles that turn numbers into dates or durations and the date system of the workbook."""
+    date_styles: frozenset[int]
+    timedelta_styles: frozenset[int]
+    epoch: datetime
+
+
+def iter_rows(excel_file: BytesIO, select_columns: Callable[[tuple], Sequence[int]] | None = None) -> Iterator[tuple]:
+    """Read the rows of the active sheet in an xlsx file one at a time.
+    Values are converted like openpyxl does: text as str, numbers as int or float, booleans as bool
+    and numbers with a date or time format as datetime, time or timedelta.
+    Empty cells are None and empty rows are skipped.
+    Cells without a reference are placed in the column after the previous cell.
+
+    Args:
+        excel_file: The xlsx file to read.
+        select_columns: A function that gets the first row and returns the indexes of the columns
+            to read from the following rows. Other cells are skipped without being decoded.
+
+    Yields:
+        The first row in full and the selected columns of the following rows.
+    """
+    with zipfile.ZipFile(excel_file) as archive:
+        sheet_path, epoch = _read_workbook(archive)
+        shared_strings = _read_shared_strings(archive)
+        styles = _read_styles(archive, epoch)
+        header_read = False
+        columns: dict[int, int] = {}
+
+        with archive.open(sheet_path) as sheet:
+            for _, element in ElementTree.iterparse(sheet):
+                if _local_name(element.tag) != 'row':
+                    continue
+
+                cells = {}
+                column = -1
+                for cell in element:
+                    # The reference is optional, and cells without one follow the previous cell
+                    reference = cell.get('r')
+                    column = _column_index(reference) if reference else column + 1
+                    if not header_read or column in columns:
+                        cells[column] = cell
+
+                element.clear()
+
+                if not cells:
+                    continue
+
+                if not header_read:
+                    header_read = True
+                    row = tuple(_cell_value(cells.get(i), shared_strings, styles) for i in range(max(cells) + 1))
+                    if select_columns:
+                        columns = {column: position for position, column in enumerate(select_columns(row))}
+                    else:
+                        columns = {column: column for column in range(len(row))}
+                    yield row
+                else:
+                    row = [None] * len(columns)
+                    for column, cell in cells.items():
+                        row[columns[column]] = _cell_value(cell, shared_strings, styles)
+                    yield tuple(row)
+
+
+def _local_name(tag: str) -> str:
+    """Remove the namespace from an xml tag."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _column_index(reference: str) -> int:
+    """Convert a cell reference like 'AB12' to a zero based column index."""
+    index = 0
+    for char in reference:
+        if char.isdigit():
+            break
+        index = index * 26 + ord(char) - ord('A') + 1
+    return index - 1
+
+
+def _read_workbook(archive: zipfile.ZipFile) -> tuple[str, datetime]:
+    """Find the path of the active sheet and the date system of an xlsx archive."""
+    workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+    active_tab = 0
+    epoch = CALENDAR_WINDOWS_1900
+    sheet_ids = []
+
+    for element in workbook.iter():
+        name = _local_name(element.tag)
+        if name == 'workbookView':
+            active_tab = int(element.get('activeTab', 0))
+        elif name == 'workbookPr':
+            if element.get('date1904', 'false').lower() in ('1', 'true'):
+                epoch = CALENDAR_MAC_1904
+        elif name == 'sheet':
+            # The relationship namespace differs between transitional and strict files
+            sheet_ids.append(next(value for key, value in element.attrib.items() if _local_name(key) == 'id'))
+
+    relationships = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    targets = {element.get('Id'): element.get('Target') for element in relationships}
+
+    target = targets[sheet_ids[min(active_tab, len(sheet_ids) - 1)]]
+    if target.startswith('/'):
+        return target[1:], epoch
+    return posixpath.normpath(posixpath.join('xl', target)), epoch
+
+
+def _read_styles(archive: zipfile.ZipFile, epoch: datetime) -> Styles:
+    """Find the cell styles with a date, time or duration number format."""
+    if 'xl/styles.xml' not in archive.namelist():
+        return Styles(frozenset(), frozenset(), epoch)
+
+    stylesheet = ElementTree.fromstring(archive.read('xl/styles.xml'))
+    number_formats = dict(BUILTIN_FORMATS)
+    cell_formats = []
+
+    for element in stylesheet:
+        name = _local_name(element.tag)
+        if name == 'numFmts':
+            number_formats.update((int(number_format.get('numFmtId')), number_format.get('formatCode')) for number_format in element)
+        elif name == 'cellXfs':
+            cell_formats = [int(cell_format.get('numFmtId', 0)) for cell_format in element]
+
+    date_styles = set()
+    timedelta_styles = set()
+    for style, number_format_id in enumerate(cell_formats):
+        number_format = number_formats.get(number_format_id)
+        if number_format and is_date_format(number_format):
+            date_styles.add(style)
+            if is_timedelta_format(number_format):
+                timedelta_styles.add(style)
+
+    return Styles(frozenset(date_styles), frozenset(timedelta_styles), epoch)
+
+
+def _read_shared_strings(archive: zipfile.ZipFile) -> list[str]:
+    """Read the shared strings of an xlsx archive if any."""
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return []
+
+    strings = []
+    with archive.open('xl/sharedStrings.xml') as file:
+        for _, element in ElementTree.iterparse(file):
+            if _local_name(element.tag) == 'si':
+                strings.append(_text(element))
+                element.clear()
+
+    return strings
+
+
+def _text(element: ElementTree.Element) -> str:
+    """Join the text of a string item. Phonetic runs are skipped."""
+    parts = []
+    for child in element:
+        name = _local_name(child.tag)
+        if name == 't':
+            parts.append(child.text or "")
+        elif name == 'r':
+            parts.extend(t.text or "" for t in child if _local_name(t.tag) == 't')
+    return "".join(parts)
+
+
+def _cell_value(cell: ElementTree.Element | None, shared_strings: list[str], styles: Styles) -> Any:
+    """Convert a cell element to a Python value."""
+    if cell is None:
+        return None
+
+    cell_type = cell.get('t', 'n')
+    value = None
+
+    for child in cell:
+        name = _local_name(child.tag)
+        if cell_type == 'inlineStr' and name == 'is':
+            return _text(child)
+        if name == 'v':
+            value = child.text
+            break
+
+    if value is None:
+        return None
+
+    match cell_type:
+        case 's':
+            value = shared_strings[int(value)]
+        case 'b':
+            value = value == '1'
+        case 'n':
+            value = float(value) if '.' in value or 'E' in value.upper() else int(value)
+            style = int(cell.get('s', 0))
+            if style in styles.date_styles:
+                value = from_excel(value, styles.epoch, timedelta=style in styles.timedelta_styles)
+        case 'd':
+            value = from_ISO8601(value)
+
+    return value